@@ -0,0 +1,21 @@
+"""
+ASGI config for Capital Dock Checker project.
+
+Serves the same application as config.wsgi, long polling views like
+status/batch do not hold a worker thread while they wait when it runs
+under an ASGI server.
+
+"""
+import os
+import sys
+from pathlib import Path
+
+from django.core.asgi import get_asgi_application
+
+# This allows easy placement of apps within the interior
+# dock_checker directory.
+ROOT_DIR = Path(__file__).resolve(strict=True).parent.parent
+sys.path.append(str(ROOT_DIR / "dock_checker"))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.production")
+
+application = get_asgi_application()
@@ -150,6 +150,13 @@
 MEDIA_ROOT = str(APPS_DIR / "media")
 # https://docs.djangoproject.com/en/dev/ref/settings/#media-url
 MEDIA_URL = "/media/"
+# https://docs.djangoproject.com/en/dev/ref/settings/#data-upload-max-number-files
+# bulk uploads send many pdfs in one form, bigger imports should be zipped
+DATA_UPLOAD_MAX_NUMBER_FILES = env.int("DATA_UPLOAD_MAX_NUMBER_FILES", default=1000)
+# limits of every zip archive of a bulk upload: number of files and their total
+# uncompressed size in bytes
+BULK_UPLOAD_MAX_ZIP_MEMBERS = env.int("BULK_UPLOAD_MAX_ZIP_MEMBERS", default=10_000)
+BULK_UPLOAD_MAX_ZIP_SIZE = env.int("BULK_UPLOAD_MAX_ZIP_SIZE", default=10 * 1024**3)
 
 # TEMPLATES
 # ------------------------------------------------------------------------------
@@ -211,6 +218,8 @@
 # https://docs.djangoproject.com/en/dev/ref/settings/#logging
 # See https://docs.djangoproject.com/en/dev/topics/logging for
 # more details on how to customize your logging configuration.
+# file handlers write to logs/ of the working directory, which is not versioned
+Path("logs").mkdir(exist_ok=True)
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -302,12 +311,57 @@
 CELERY_TASK_TIME_LIMIT = 20 * 60
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#task-soft-time-limit
 CELERY_TASK_SOFT_TIME_LIMIT = 10 * 60
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-max-memory-per-child
+# in kilobytes, worker child is replaced after a task that pushed it over the limit
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = env.int(
+    "CELERY_WORKER_MAX_MEMORY_PER_CHILD", default=2 * 1024 * 1024
+)
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#beat-scheduler
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-send-task-events
 CELERY_WORKER_SEND_TASK_EVENTS = True
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#std-setting-task_send_sent_event
 CELERY_TASK_SEND_SENT_EVENT = True
+# Document processing
+# ------------------------------------------------------------------------------
+# rss in megabytes after which pdfminer caches are dropped while streaming pages
+PDF_EXTRACTION_MAX_MEMORY = env.int("PDF_EXTRACTION_MAX_MEMORY", default=1024)
+# seconds of matching after which the task continues in a new one, keep it
+# below CELERY_TASK_SOFT_TIME_LIMIT
+PDF_MATCHING_CHUNK_TIME = env.int("PDF_MATCHING_CHUNK_TIME", default=5 * 60)
+# pages between saves of partial matches
+PDF_MATCHING_CHECKPOINT_PAGES = env.int("PDF_MATCHING_CHECKPOINT_PAGES", default=25)
+# seconds a title update waits for newer edits of the same title before matching
+TITLE_UPDATE_DEBOUNCE = env.float("TITLE_UPDATE_DEBOUNCE", default=2)
+# titles suggested per document, matches of each are precomputed in background
+# at celery priority TITLE_CANDIDATES_PRIORITY (0 is the highest on redis)
+TITLE_CANDIDATES = env.int("TITLE_CANDIDATES", default=5)
+TITLE_CANDIDATES_PRIORITY = env.int("TITLE_CANDIDATES_PRIORITY", default=9)
+# stop scoring titles with the first models of the ensemble once the best one is
+# clear, needs a margin calibrated by python -m ml.calibrate for the checkpoint
+TITLE_CASCADE = env.bool("TITLE_CASCADE", default=True)
+# pair words of matches with the title by alignment, not by position
+PDF_MATCHING_ALIGN_WORDS = env.bool("PDF_MATCHING_ALIGN_WORDS", default=True)
+# page text boxes of matching, "pdfminer" or "pymupdf" (faster, boxes and so
+# matches differ), page count, highlighting and rendering always use PyMuPDF
+PDF_LAYOUT_BACKEND = env.str("PDF_LAYOUT_BACKEND", default="pdfminer")
+# seconds serialized file payloads are cached under their version, 0 disables
+FILE_PAYLOAD_CACHE_TIMEOUT = env.int("FILE_PAYLOAD_CACHE_TIMEOUT", default=60 * 60)
+# max-age of rendered page images served by media_view in development, they never
+# change under the same url, compose/production/nginx/default.conf sets it in production
+PAGE_IMAGE_MAX_AGE = env.int("PAGE_IMAGE_MAX_AGE", default=365 * 24 * 60 * 60)
+# seconds between redis reads of a waiting status long poll and its longest wait
+STATUS_POLL_INTERVAL = env.float("STATUS_POLL_INTERVAL", default=0.5)
+STATUS_POLL_MAX_TIMEOUT = env.int("STATUS_POLL_MAX_TIMEOUT", default=30)
+# cache of matching results shared by documents: entries kept per worker process,
+# redis url of the shared tier (off when empty, values are pickled, so only a
+# trusted instance) and its ttl in seconds
+ML_RESULT_CACHE_SIZE = env.int("ML_RESULT_CACHE_SIZE", default=100_000)
+ML_RESULT_CACHE_URL = env("ML_RESULT_CACHE_URL", default="")
+ML_RESULT_CACHE_TTL = env.int("ML_RESULT_CACHE_TTL", default=7 * 24 * 60 * 60)
+# page texts kept per worker process for matching another title of a document
+ML_PAGE_CACHE_SIZE = env.int("ML_PAGE_CACHE_SIZE", default=2_000)
+
 # DRF
 # -------------------------------------------------------------------------------
 # django-rest-framework - https://www.django-rest-framework.org/api-guide/settings/
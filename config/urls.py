@@ -7,12 +7,16 @@
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 from rest_framework.authtoken.views import obtain_auth_token
 
+from dock_checker.common.views import media_view, metrics_view
+
 urlpatterns = [
     # Django Admin, use {% url 'admin:index' %}
     path(settings.ADMIN_URL, admin.site.urls),
     # User management
     # Your stuff: custom urls includes go here
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path("metrics", metrics_view, name="metrics"),
+    # development only, nginx serves media in production
+] + static(settings.MEDIA_URL, view=media_view, document_root=settings.MEDIA_ROOT)
 # API URLS
 urlpatterns += [
     # API base url
@@ -1,4 +1,9 @@
+import threading
+from contextlib import contextmanager
+
 from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
 
 
 def incr_key(key, value, timeout=None):
@@ -23,3 +28,131 @@ def get_key(key):
 
 def delete_key(key):
     return cache.delete(key)
+
+
+def get_many(keys):
+    """Reads all keys in one MGET, missing keys are left out"""
+    return cache.get_many(keys)
+
+
+def set_many(data, timeout=None):
+    """Writes all keys with the same timeout in one pipeline"""
+    return cache.set_many(data, timeout=timeout)
+
+
+def _set_fields(client, key, fields, timeout):
+    key = cache.make_key(key)
+    client.hset(key, mapping={f: cache.client.encode(v) for f, v in fields.items()})
+    if timeout is not None:
+        client.expire(key, timeout)
+
+
+def set_fields(key, fields, timeout=None):
+    """Updates several fields of a hash at once, readers never see half of them"""
+    pipe = get_redis_connection("default").pipeline(transaction=True)
+    _set_fields(pipe, key, fields, timeout)
+    pipe.execute()
+
+
+def incr_field(key, field, amount=1, timeout=None):
+    """Atomically increments integer field of a hash, returns the new value"""
+    pipe = get_redis_connection("default").pipeline(transaction=True)
+    pipe.hincrby(cache.make_key(key), field, amount)
+    if timeout is not None:
+        pipe.expire(cache.make_key(key), timeout)
+    return pipe.execute()[0]
+
+
+def _decode_fields(raw):
+    return {field.decode(): cache.client.decode(value) for field, value in raw.items()}
+
+
+def get_fields(key):
+    """Reads whole hash, empty dict when it does not exist"""
+    raw = get_redis_connection("default").hgetall(cache.make_key(key))
+    return _decode_fields(raw)
+
+
+def get_fields_many(keys):
+    """Reads many hashes in one round trip"""
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(cache.make_key(key))
+    return [_decode_fields(raw) for raw in pipe.execute()]
+
+
+class CachePipeline:
+    """Collects writes and sends them to redis together"""
+
+    def __init__(self):
+        self.pipe = get_redis_connection("default").pipeline(transaction=False)
+
+    def set_key(self, key, value, timeout=None):
+        cache.set(key, value, timeout=timeout, client=self.pipe)
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set_key(key, value, timeout=timeout)
+
+    def delete_key(self, key):
+        cache.delete(key, client=self.pipe)
+
+    def set_fields(self, key, fields, timeout=None):
+        _set_fields(self.pipe, key, fields, timeout)
+
+
+@contextmanager
+def pipeline():
+    """
+    Pipelines all writes made inside the block
+
+        with pipeline() as pipe:
+            pipe.set_key("a", 1)
+            pipe.set_fields("b", {"c": 2})
+
+    Writes are sent on exit of the block and dropped if it raises.
+    """
+    pipe = CachePipeline()
+    yield pipe
+    pipe.pipe.execute()
+
+
+def _keep_alive(redis_lock, interval, stop):
+    while not stop.wait(interval):
+        try:
+            redis_lock.reacquire()
+        except LockError:
+            # expired meanwhile and possibly taken by someone else
+            return
+
+
+@contextmanager
+def lock(key, timeout, blocking=False, blocking_timeout=None, keep_alive=False):
+    """
+    Redis lock around the block, yields whether it was acquired
+
+        with lock(f"render-{pk}", timeout=600) as acquired:
+            if not acquired:
+                return
+
+    timeout bounds how long a crashed holder keeps the lock. With keep_alive
+    a thread renews it every third of timeout while the block runs, so a
+    short timeout frees locks of killed workers soon whatever the block takes.
+    """
+    redis_lock = cache.lock(f"lock-{key}", timeout=timeout, thread_local=not keep_alive)
+    acquired = redis_lock.acquire(blocking=blocking, blocking_timeout=blocking_timeout)
+    stop = threading.Event()
+    if acquired and keep_alive:
+        threading.Thread(
+            target=_keep_alive, args=(redis_lock, timeout / 3, stop), daemon=True
+        ).start()
+    try:
+        yield acquired
+    finally:
+        stop.set()
+        if acquired:
+            try:
+                redis_lock.release()
+            except LockError:
+                # expired and possibly taken by someone else
+                pass
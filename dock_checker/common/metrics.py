@@ -0,0 +1,32 @@
+from django_redis import get_redis_connection
+
+from ml import metrics
+
+METRICS_KEY = "dock_checker:metrics"
+
+
+def flush_metrics():
+    """Moves process local stage timings to redis, so web can export them"""
+    data = metrics.drain()
+    if not data:
+        return
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for (stage, pages), series in data.items():
+        for i, value in enumerate(series[:-1]):
+            if value:
+                pipe.hincrby(METRICS_KEY, f"{stage}|{pages}|{i}", value)
+        pipe.hincrbyfloat(METRICS_KEY, f"{stage}|{pages}|sum", series[-1])
+    pipe.execute()
+
+
+def load_metrics() -> dict[tuple[str, str], list]:
+    size = len(metrics.BUCKETS) + 1
+    data = {}
+    for field, value in get_redis_connection("default").hgetall(METRICS_KEY).items():
+        stage, pages, index = field.decode().split("|")
+        series = data.setdefault((stage, pages), [0] * size + [0.0])
+        if index == "sum":
+            series[-1] = float(value)
+        else:
+            series[int(index)] = int(value)
+    return data
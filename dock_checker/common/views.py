@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.static import serve
+
+from dock_checker.common.metrics import flush_metrics, load_metrics
+from ml import metrics
+
+
+def metrics_view(request):
+    flush_metrics()
+    return HttpResponse(
+        metrics.render(load_metrics()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+def media_view(request, path, document_root=None, show_indexes=False):
+    """Serves media in development with the cache headers nginx sets in production"""
+    response = serve(request, path, document_root, show_indexes)
+    if path.startswith("pages/") and response.status_code == 200:
+        patch_cache_control(
+            response, public=True, max_age=settings.PAGE_IMAGE_MAX_AGE, immutable=True
+        )
+    return response
@@ -1,16 +1,30 @@
+import zipfile
+import zlib
+
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.urls import reverse
 from drf_spectacular.utils import extend_schema_field
 from rest_framework import serializers
 
-from dock_checker.processor.models import File, FileImage
+from dock_checker.processor.models import File, FileImage, FileState
+from dock_checker.processor.services import submit_batch
+from dock_checker.processor.status import update_status
+from dock_checker.processor.uploads import (
+    StoredUploadedFile,
+    discard_uploads,
+    iter_zip_pdfs,
+)
+from dock_checker.utils.zip import ZipfileField
 
 
 class TaskSerializer(serializers.Serializer):
     processed = serializers.IntegerField()
     total = serializers.IntegerField()
+    matched = serializers.IntegerField()
     features_loaded = serializers.BooleanField()
     error = serializers.BooleanField()
     error_description = serializers.CharField()
+    state = serializers.ChoiceField(choices=FileState.choices)
 
 
 class FileImageSerializer(serializers.ModelSerializer):
@@ -40,9 +54,18 @@ def get_file_url(self, obj):
 
     class Meta:
         model = File
-        fields = ["name", "ideal_title", "file", "file_url", "preview", "status"]
+        fields = [
+            "name",
+            "ideal_title",
+            "state",
+            "file",
+            "file_url",
+            "preview",
+            "status",
+        ]
         extra_kwargs = {
             "ideal_title": {"read_only": True},
+            "state": {"read_only": True},
             "status": {"read_only": True},
             "name": {"read_only": True},
             "preview": {"read_only": True},
@@ -50,26 +73,160 @@ class Meta:
         }
 
     def create(self, validated_data):
+        uploaded = validated_data["file"]
+        if not isinstance(uploaded, StoredUploadedFile):
+            return File.objects.create(file=uploaded, name=uploaded.name)
+        # already written to storage by the upload handler, only point at it
         obj = File.objects.create(
-            file=validated_data["file"], name=validated_data["file"].name
+            file=uploaded.storage_name, name=uploaded.name, sha256=uploaded.sha256
         )
+        if uploaded.pages:
+            update_status(obj.pk, total=uploaded.pages)
         return obj
 
 
+class TitleCandidateSerializer(serializers.Serializer):
+    title = serializers.CharField()
+    probability = serializers.FloatField()
+
+
 class FullFileSerializer(FileSerializer):
-    images = FileImageSerializer(many=True)
+    pages = serializers.SerializerMethodField(method_name="get_pages")
+    images_url = serializers.SerializerMethodField(method_name="get_images_url")
+    matches_url = serializers.SerializerMethodField(method_name="get_matches_url")
+    title_candidates = serializers.SerializerMethodField(
+        method_name="get_title_candidates"
+    )
+
+    def get_pages(self, obj) -> int:
+        return obj.images.count()
+
+    @extend_schema_field(TitleCandidateSerializer(many=True))
+    def get_title_candidates(self, obj):
+        return TitleCandidateSerializer(obj.title_candidates, many=True).data
+
+    @extend_schema_field(serializers.URLField)
+    def get_images_url(self, obj):
+        return reverse("api:file_images", kwargs={"pk": obj.id})
+
+    @extend_schema_field(serializers.URLField)
+    def get_matches_url(self, obj):
+        return reverse("api:file_matches", kwargs={"pk": obj.id})
 
     class Meta:
         model = File
         fields = [
             "name",
             "ideal_title",
+            "state",
             "file",
             "processed_file",
-            "images",
-            "text_locations",
+            "preview",
+            "pages",
+            "images_url",
+            "matches_count",
+            "matched_pages",
+            "matches_url",
+            "title_candidates",
         ]
 
 
+class MatchesSerializer(serializers.Serializer):
+    page_from = serializers.IntegerField()
+    page_to = serializers.IntegerField()
+    matched_pages = serializers.IntegerField()
+    matches = serializers.ListField(child=serializers.JSONField())
+
+
+class ChunkedUploadSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=500)
+    size = serializers.IntegerField(min_value=1)
+    id = serializers.CharField(read_only=True)
+    offset = serializers.IntegerField(read_only=True)
+
+    def validate_name(self, value):
+        if not value.lower().endswith(".pdf"):
+            raise serializers.ValidationError("only pdf files are allowed")
+        return value
+
+
+class BatchStatusSerializer(serializers.Serializer):
+    files = serializers.IntegerField()
+    done = serializers.IntegerField()
+    failed = serializers.IntegerField()
+    pages_processed = serializers.IntegerField()
+    pages_total = serializers.IntegerField()
+
+
+class BulkUploadSerializer(serializers.Serializer):
+    files = serializers.ListField(
+        child=serializers.FileField(), allow_empty=False, write_only=True
+    )
+    id = serializers.CharField(read_only=True)
+    total = serializers.IntegerField(read_only=True)
+    status = serializers.SerializerMethodField(method_name="get_status")
+
+    @extend_schema_field(serializers.URLField)
+    def get_status(self, obj):
+        return reverse("api:batch_status", kwargs={"pk": obj["id"]})
+
+    def validate_files(self, value):
+        uploads = []
+        for upload in value:
+            if isinstance(upload, StoredUploadedFile):
+                uploads.append(upload)
+            elif upload.name.lower().endswith(".zip"):
+                try:
+                    uploads.append(ZipfileField().clean(upload))
+                except DjangoValidationError as e:
+                    raise serializers.ValidationError(e.messages)
+            else:
+                raise serializers.ValidationError(
+                    f"{upload.name}: only pdf and zip files are allowed"
+                )
+        return uploads
+
+    def create(self, validated_data):
+        stored = []
+        try:
+            for upload in validated_data["files"]:
+                if isinstance(upload, zipfile.ZipFile):
+                    stored.extend(iter_zip_pdfs(upload))
+                else:
+                    stored.append(upload)
+            files = File.objects.bulk_create(
+                [
+                    File(
+                        file=upload.storage_name,
+                        name=upload.name,
+                        sha256=upload.sha256,
+                    )
+                    for upload in stored
+                ],
+                batch_size=1000,
+            )
+            pages = {str(file.pk): upload.pages for file, upload in zip(files, stored)}
+            batch_id = submit_batch(files, pages)
+        except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+            discard_uploads(stored)
+            raise serializers.ValidationError({"files": [f"broken archive: {e}"]})
+        except BaseException:
+            # pdfs unpacked from archives are not known to the view
+            discard_uploads(stored)
+            raise
+        return {"id": batch_id, "total": len(files)}
+
+
 class UpdateFileTitleSerializer(serializers.Serializer):
     title = serializers.CharField()
+
+
+class UpdatedTitleFileSerializer(FileSerializer):
+    """File switched to a precomputed title candidate, matches are final"""
+
+    class Meta(FileSerializer.Meta):
+        fields = FileSerializer.Meta.fields + [
+            "text_locations",
+            "matched_pages",
+            "matches_count",
+        ]
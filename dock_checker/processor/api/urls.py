@@ -1,17 +1,35 @@
 from django.urls import path
 
 from dock_checker.processor.api.views import (
+    BulkUploadApiView,
+    ChunkedUploadApiView,
+    CreateChunkedUploadApiView,
     CreateFileApiView,
+    RetrieveBatchStatusApiView,
     RetrieveTaskApiView,
     ListFileApiView,
+    ListFileImagesApiView,
     RetrieveFileApiView,
+    RetrieveFileMatchesApiView,
     UpdateFileTitleApiView,
+    batch_status_view,
 )
 
 urlpatterns = [
     path("list", ListFileApiView.as_view()),
     path("upload/", CreateFileApiView.as_view()),
+    path("upload/chunked/", CreateChunkedUploadApiView.as_view()),
+    path("upload/chunked/<str:pk>", ChunkedUploadApiView.as_view()),
+    path("upload/bulk/", BulkUploadApiView.as_view()),
+    path("batch/<str:pk>", RetrieveBatchStatusApiView.as_view(), name="batch_status"),
+    path("status/batch", batch_status_view, name="status_batch"),
     path("status/<str:pk>", RetrieveTaskApiView.as_view(), name="status"),
     path("file/<str:pk>", RetrieveFileApiView.as_view(), name="file"),
+    path("file/<str:pk>/images", ListFileImagesApiView.as_view(), name="file_images"),
+    path(
+        "file/<str:pk>/matches",
+        RetrieveFileMatchesApiView.as_view(),
+        name="file_matches",
+    ),
     path("file/<str:pk>/update/", UpdateFileTitleApiView.as_view()),
 ]
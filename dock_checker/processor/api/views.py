@@ -1,4 +1,16 @@
+import hashlib
+from bisect import bisect_left, bisect_right
+import json
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from rest_framework import status
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.generics import (
     GenericAPIView,
@@ -9,15 +21,43 @@
 )
 from rest_framework.response import Response
 
+from dock_checker.common.cache import add_key, delete_key, get_key, set_key
 from dock_checker.processor.api.serializers import (
+    BatchStatusSerializer,
+    BulkUploadSerializer,
+    ChunkedUploadSerializer,
     TaskSerializer,
+    FileImageSerializer,
     FileSerializer,
     FullFileSerializer,
+    MatchesSerializer,
     UpdateFileTitleSerializer,
+    UpdatedTitleFileSerializer,
+)
+from dock_checker.processor.models import File, FileImage
+from dock_checker.processor.services import (
+    apply_title_candidate,
+    find_title_candidate,
+    get_batch_status,
+    get_task_status,
+    request_title_update,
+    wait_task_statuses,
 )
-from dock_checker.processor.models import File
-from dock_checker.processor.services import get_task_status
-from dock_checker.processor.tasks import update_pdf_features
+from dock_checker.processor.uploads import (
+    CHUNKED_UPLOAD_LOCK_TTL,
+    StreamingPdfUploadHandler,
+    complete_chunked_upload,
+    create_chunked_upload,
+    discard_uploads,
+    finish_chunked_upload,
+    get_chunked_upload,
+    write_chunk,
+)
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+MAX_STATUS_BATCH = 500
+# pages of matches returned when page_to is not given
+MATCHES_PAGE_RANGE = 50
 
 
 class RetrieveTaskApiView(GenericAPIView):
@@ -28,29 +68,282 @@ def get(self, request, pk):
         return Response(data=data, status=status.HTTP_200_OK)
 
 
+@transaction.non_atomic_requests
+async def batch_status_view(request):
+    """
+    Statuses of many files in one request
+
+        GET status/batch?ids=<pk>,<pk>&version=<version>&timeout=25
+        POST status/batch {"ids": [...], "version": ..., "timeout": 25}
+
+    With version from a previous response the request waits up to timeout
+    seconds until any of the statuses changes, unknown files have null status.
+    """
+    if request.method == "GET":
+        params = request.GET
+        ids = [pk for value in params.getlist("ids") for pk in value.split(",") if pk]
+    elif request.method == "POST":
+        try:
+            params = json.loads(request.body)
+            ids = [str(pk) for pk in params.get("ids", [])]
+        except (ValueError, TypeError, AttributeError):
+            return JsonResponse({"detail": "expected json object"}, status=400)
+    else:
+        return HttpResponseNotAllowed(["GET", "POST"])
+    if not ids or len(ids) > MAX_STATUS_BATCH:
+        return JsonResponse(
+            {"ids": [f"pass from 1 to {MAX_STATUS_BATCH} ids"]}, status=400
+        )
+    try:
+        timeout = float(params.get("timeout") or 0)
+    except (ValueError, TypeError):
+        return JsonResponse({"timeout": ["must be a number"]}, status=400)
+    timeout = min(max(timeout, 0), settings.STATUS_POLL_MAX_TIMEOUT)
+
+    version, statuses = await wait_task_statuses(
+        list(dict.fromkeys(ids)), params.get("version"), timeout
+    )
+    return JsonResponse({"version": version, "statuses": statuses})
+
+
+# api clients are not expected to send csrf tokens, as with DRF views
+batch_status_view.csrf_exempt = True
+
+
 class UpdateFileTitleApiView(GenericAPIView):
     serializer_class = UpdateFileTitleSerializer
 
     def post(self, request, pk):
         file = get_object_or_404(File, pk=pk)
-        update_pdf_features.apply_async(
-            kwargs={"pk": file.pk, "target": request.data["title"]},
-            countdown=1,
-        )
+        title = request.data["title"]
+        candidate = find_title_candidate(file, title)
+        if candidate is not None:
+            apply_title_candidate(file, candidate)
+            data = UpdatedTitleFileSerializer().to_representation(file)
+            return Response(data=data, status=status.HTTP_200_OK)
+        request_title_update(str(file.pk), title)
         data = FileSerializer().to_representation(file)
         return Response(data=data, status=status.HTTP_200_OK)
 
 
-class RetrieveFileApiView(RetrieveAPIView):
+class VersionedFileMixin:
+    """
+    Conditional responses for data derived from a File
+
+    ETag and Last-Modified come from File version, bumped on every pipeline
+    write, so unchanged documents are answered with 304 after one small
+    query. Payloads are cached for FILE_PAYLOAD_CACHE_TIMEOUT seconds under
+    the version, 0 turns the cache off.
+    """
+
+    def versioned_response(self, request, pk, build):
+        state = get_object_or_404(File.objects.values("version", "updated"), pk=pk)
+        updated = state["updated"]
+        etag = quote_etag(f"{pk}-{state['version']}-{updated.timestamp():.6f}")
+        last_modified = int(updated.timestamp())
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            timeout = settings.FILE_PAYLOAD_CACHE_TIMEOUT
+            # urls in payload are absolute, so host is part of the key
+            key = (
+                "file-payload-"
+                + hashlib.blake2b(
+                    f"{etag}{request.build_absolute_uri()}".encode(), digest_size=16
+                ).hexdigest()
+            )
+            data = get_key(key) if timeout else None
+            if data is None:
+                data = build()
+                if timeout:
+                    set_key(key, data, timeout=timeout)
+            response = Response(data=data, status=status.HTTP_200_OK)
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class RetrieveFileApiView(VersionedFileMixin, RetrieveAPIView):
     queryset = File.objects.all()
     serializer_class = FullFileSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        return self.versioned_response(
+            request,
+            kwargs["pk"],
+            lambda: dict(self.get_serializer(self.get_object()).data),
+        )
+
 
-class CreateFileApiView(CreateAPIView):
+class StreamingUploadMixin:
     parser_classes = [FormParser, MultiPartParser]
+
+    def initialize_request(self, request, *args, **kwargs):
+        # must be set before the body is read, pdfs go straight to storage
+        request.upload_handlers = [
+            StreamingPdfUploadHandler(request),
+            *request.upload_handlers,
+        ]
+        return super().initialize_request(request, *args, **kwargs)
+
+
+class CreateFileApiView(StreamingUploadMixin, CreateAPIView):
     serializer_class = FileSerializer
 
 
+class BulkUploadApiView(StreamingUploadMixin, CreateAPIView):
+    """Uploads many pdfs or zip archives of pdfs, processed as one batch"""
+
+    serializer_class = BulkUploadSerializer
+
+    def create(self, request, *args, **kwargs):
+        try:
+            return super().create(request, *args, **kwargs)
+        except Exception:
+            discard_uploads(request.FILES.getlist("files"))
+            raise
+
+
+class RetrieveBatchStatusApiView(GenericAPIView):
+    serializer_class = BatchStatusSerializer
+
+    def get(self, request, pk):
+        data = get_batch_status(pk)
+        return Response(data=data, status=status.HTTP_200_OK)
+
+
+class CreateChunkedUploadApiView(GenericAPIView):
+    """Starts resumable upload, recommended for files over 100 MB"""
+
+    serializer_class = ChunkedUploadSerializer
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        upload = create_chunked_upload(
+            serializer.validated_data["name"], serializer.validated_data["size"]
+        )
+        data = ChunkedUploadSerializer({**upload, "offset": 0}).data
+        return Response(data=data, status=status.HTTP_201_CREATED)
+
+
+class ChunkedUploadApiView(GenericAPIView):
+    """
+    Appends chunks to resumable upload
+
+    Chunk is sent as raw body of PUT with Content-Range header, GET returns
+    offset to resume from after a failed request. Last chunk creates the file,
+    retrying it returns the created one.
+    """
+
+    serializer_class = ChunkedUploadSerializer
+
+    def get_upload(self, pk):
+        upload = get_chunked_upload(pk)
+        if upload is None:
+            raise NotFound("given upload does not exist")
+        return upload
+
+    def get(self, request, pk):
+        data = ChunkedUploadSerializer(self.get_upload(pk)).data
+        return Response(data=data, status=status.HTTP_200_OK)
+
+    def put(self, request, pk):
+        upload = self.get_upload(pk)
+        match = CONTENT_RANGE.fullmatch(request.headers.get("Content-Range", ""))
+        if not match:
+            raise ValidationError({"Content-Range": "bytes <start>-<end>/<size>"})
+        start, end, size = map(int, match.groups())
+        if size != upload["size"] or end < start or end >= size:
+            raise ValidationError({"Content-Range": "does not fit the upload"})
+        if not add_key(f"upload-{pk}-lock", 1, CHUNKED_UPLOAD_LOCK_TTL):
+            data = ChunkedUploadSerializer(upload).data
+            return Response(data=data, status=status.HTTP_409_CONFLICT)
+        try:
+            # offset is read again under the lock, so two requests with the
+            # same start can't both append their bytes
+            upload = self.get_upload(pk)
+            if "file" in upload and end == size - 1:
+                # response to the last chunk was lost and the client retries it
+                file = get_object_or_404(File, pk=upload["file"])
+                return self.file_response(file, status.HTTP_200_OK)
+            if start != upload["offset"]:
+                data = ChunkedUploadSerializer(upload).data
+                return Response(data=data, status=status.HTTP_409_CONFLICT)
+            if request.stream is not None:
+                upload["offset"] = write_chunk(upload, request.stream, end - start + 1)
+            if upload["offset"] < upload["size"]:
+                data = ChunkedUploadSerializer(upload).data
+                return Response(data=data, status=status.HTTP_200_OK)
+            file = FileSerializer().create({"file": complete_chunked_upload(upload)})
+            finish_chunked_upload(upload, file.pk)
+        finally:
+            delete_key(f"upload-{pk}-lock")
+        return self.file_response(file, status.HTTP_201_CREATED)
+
+    def file_response(self, file: File, code: int) -> Response:
+        data = FileSerializer(file, context=self.get_serializer_context()).data
+        return Response(data=data, status=code)
+
+
+class FileImagePagination(LimitOffsetPagination):
+    default_limit = 20
+    max_limit = 200
+
+
+class ListFileImagesApiView(VersionedFileMixin, ListAPIView):
+    """Rendered pages of a file, paginated with offset and limit"""
+
+    serializer_class = FileImageSerializer
+    pagination_class = FileImagePagination
+
+    def get_queryset(self):
+        return FileImage.objects.filter(file_id=self.kwargs["pk"])
+
+    def list(self, request, *args, **kwargs):
+        def build():
+            return dict(super(ListFileImagesApiView, self).list(request).data)
+
+        return self.versioned_response(request, kwargs["pk"], build)
+
+
+class RetrieveFileMatchesApiView(VersionedFileMixin, GenericAPIView):
+    """Matches on pages from page_from to page_to, both included"""
+
+    serializer_class = MatchesSerializer
+
+    def get(self, request, pk):
+        try:
+            page_from = int(request.query_params.get("page_from", 1))
+            page_to = int(
+                request.query_params.get("page_to", page_from + MATCHES_PAGE_RANGE - 1)
+            )
+        except ValueError:
+            raise ValidationError("page_from and page_to must be integers")
+        if page_from < 1 or page_to < page_from:
+            raise ValidationError("expected 1 <= page_from <= page_to")
+
+        def build():
+            file = File.objects.only("text_locations", "matched_pages").get(pk=pk)
+            locations = file.text_locations or []
+            # matches are stored in page order
+            start = bisect_left(locations, page_from, key=lambda loc: loc["page"])
+            end = bisect_right(locations, page_to, key=lambda loc: loc["page"])
+            return MatchesSerializer(
+                {
+                    "page_from": page_from,
+                    "page_to": page_to,
+                    "matched_pages": file.matched_pages,
+                    "matches": locations[start:end],
+                }
+            ).data
+
+        return self.versioned_response(request, pk, build)
+
+
 class ListFileApiView(ListAPIView):
     serializer_class = FileSerializer
     queryset = File.objects.all()
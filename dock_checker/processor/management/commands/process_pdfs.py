@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ml.batch import add_arguments, options_from_args, report, run_batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Processes pdf files, directories or globs with a local process pool, "
+        "without the broker or the database, and streams results to jsonl or parquet"
+    )
+
+    def add_arguments(self, parser):
+        add_arguments(parser)
+        # same defaults as the celery pipeline
+        parser.set_defaults(
+            candidates=settings.TITLE_CANDIDATES,
+            max_memory=settings.PDF_EXTRACTION_MAX_MEMORY,
+            align=settings.PDF_MATCHING_ALIGN_WORDS,
+            cascade=settings.TITLE_CASCADE,
+            layout=settings.PDF_LAYOUT_BACKEND,
+        )
+
+    def handle(self, *args, **options):
+        totals = run_batch(**options_from_args(options))
+        self.stdout.write(self.style.SUCCESS(report(totals)))
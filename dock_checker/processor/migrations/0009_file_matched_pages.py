@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0008_file_processed_file"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="matched_pages",
+            field=models.IntegerField(default=0),
+        ),
+    ]
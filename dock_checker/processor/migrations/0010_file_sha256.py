@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-19 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0009_file_matched_pages"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="sha256",
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.2 on 2026-10-19 13:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0010_file_sha256"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="updated",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="version",
+            field=models.IntegerField(default=0),
+        ),
+    ]
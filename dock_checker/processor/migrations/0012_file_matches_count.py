@@ -0,0 +1,26 @@
+# Generated by Django 4.2.2 on 2026-10-19 13:30
+
+from django.db import migrations, models
+
+
+def count_matches(apps, schema_editor):
+    File = apps.get_model("processor", "File")
+    for file in File.objects.only("text_locations").iterator():
+        file.matches_count = len(file.text_locations)
+        file.save(update_fields=["matches_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0011_file_updated_file_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="matches_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_matches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.2 on 2026-10-19 14:00
+
+from django.db import migrations, models
+
+
+def mark_existing_done(apps, schema_editor):
+    # files uploaded before states were tracked went through the pipeline already
+    File = apps.get_model("processor", "File")
+    File.objects.update(state="done")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0012_file_matches_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="state",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("extracting", "Extracting"),
+                    ("rendering", "Rendering"),
+                    ("done", "Done"),
+                    ("failed", "Failed"),
+                ],
+                db_index=True,
+                default="queued",
+                max_length=10,
+            ),
+        ),
+        migrations.RunPython(mark_existing_done, migrations.RunPython.noop),
+    ]
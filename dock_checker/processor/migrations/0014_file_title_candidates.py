@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-19 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processor", "0013_file_state"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="title_candidates",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
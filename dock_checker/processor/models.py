@@ -2,6 +2,25 @@
 
 from django.core.validators import FileExtensionValidator
 from django.db import models
+from django.utils import timezone
+
+from dock_checker.utils.choices import count_max_length
+
+
+class FileState(models.TextChoices):
+    queued = "queued"
+    extracting = "extracting"
+    rendering = "rendering"
+    done = "done"
+    failed = "failed"
+
+
+class FileQuerySet(models.QuerySet):
+    def update_content(self, **fields):
+        """Queryset update of what clients see, bumps version used for http caching"""
+        return self.update(
+            version=models.F("version") + 1, updated=timezone.now(), **fields
+        )
 
 
 class File(models.Model):
@@ -9,12 +28,27 @@ class File(models.Model):
     name = models.CharField(null=True, blank=True, max_length=500)
     ideal_title = models.CharField(null=True, blank=True, max_length=500)
     text_locations = models.JSONField(default=dict)
+    matched_pages = models.IntegerField(default=0)
+    matches_count = models.IntegerField(default=0)
+    # most probable titles, with text_locations once match_title_candidates ran
+    title_candidates = models.JSONField(default=list, blank=True)
+    state = models.CharField(
+        choices=FileState.choices,
+        default=FileState.queued,
+        max_length=count_max_length(FileState),
+        db_index=True,
+    )
     uploaded = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    version = models.IntegerField(default=0)
     file = models.FileField(
         upload_to="uploads/",
         validators=[FileExtensionValidator(allowed_extensions=["pdf"])],
     )
     processed_file = models.FileField(upload_to="processed/", null=True, blank=True)
+    sha256 = models.CharField(blank=True, max_length=64, db_index=True)
+
+    objects = FileQuerySet.as_manager()
 
     class Meta:
         ordering = ("-uploaded",)
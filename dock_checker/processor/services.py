@@ -1,28 +1,217 @@
+import asyncio
+import hashlib
+import json
+import uuid
 from typing import Tuple
 from io import BytesIO
 import re
+import threading
+import weakref
 import fitz
-from django.core.cache import cache
+from asgiref.sync import sync_to_async
+from celery import group
+from django.conf import settings
+from django.db import transaction
 from rest_framework.exceptions import NotFound
 
+from dock_checker.common.cache import get_key, pipeline, set_key
+from dock_checker.processor.models import File, FileState
+from dock_checker.processor.status import (
+    get_pipeline_status,
+    get_status,
+    get_status_many,
+    next_title_version,
+    update_status,
+)
+from dock_checker.processor.tasks import (
+    highlight_pdf,
+    process_pdf,
+    update_pdf_features,
+)
+
 
 def get_task_status(pk: str) -> dict:
-    if cache.get(f"{pk}-processed") is None:
+    status = get_status(pk)
+    if status is None:
         raise NotFound("given task does not exist")
-    created = cache.get_or_set(f"{pk}-processed", 0)
-    total = cache.get_or_set(f"{pk}-total", 0)
-    features_loaded = cache.get_or_set(f"{pk}-features_loaded", False)
-    error = cache.get_or_set(f"{pk}-error", False)
-    error_description = cache.get_or_set(f"{pk}-error_description", "")
+    return status
+
+
+def get_task_statuses(pks: list[str]) -> tuple[str, dict]:
+    """Statuses of many files in one redis round trip, with version of the whole set"""
+    statuses = dict(zip(pks, get_status_many(pks)))
+    version = hashlib.blake2b(
+        json.dumps(statuses, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+    return version, statuses
+
+
+async def wait_task_statuses(
+    pks: list[str], version: str | None = None, timeout: float = 0
+) -> tuple[str, dict]:
+    """
+    Long poll of get_task_statuses
+
+    Returns as soon as the version differs from the one client already has,
+    or after timeout seconds with the unchanged statuses.
+    """
+    read = sync_to_async(get_task_statuses, thread_sensitive=False)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    current, statuses = await read(pks)
+    while current == version and loop.time() < deadline:
+        await asyncio.sleep(min(settings.STATUS_POLL_INTERVAL, deadline - loop.time()))
+        current, statuses = await read(pks)
+    return current, statuses
+
+
+class ProcessingDispatch:
+    """on_commit callback that starts processing of all files saved in a transaction"""
+
+    def __init__(self, pks: list):
+        self.pks = dict.fromkeys(pks)
+
+    def __call__(self):
+        pks = list(self.pks)
+        if len(pks) == 1:
+            process_pdf.apply_async(kwargs={"pk": pks[0]})
+        else:
+            group(process_pdf.si(pk=pk) for pk in pks).apply_async()
+
+
+# dispatches waiting for commit by connection alias and savepoint, only
+# django holds them, so ones of rolled back savepoints are dropped here too
+_dispatches = threading.local()
+
+
+def schedule_processing(pks: list, pages: dict[str, int] | None = None):
+    """
+    Starts processing of files once the transaction saving them is committed
+
+    Files scheduled in one transaction are sent as one celery group, a file
+    scheduled twice is processed once. Outside of a transaction processing
+    starts immediately. pages are sniffed page counts shown as status total
+    until process_pdf reads the real ones.
+    """
+    pages = pages or {}
+    pks = [str(pk) for pk in pks]
+    with pipeline() as pipe:
+        for pk in pks:
+            update_status(
+                pk,
+                pipe,
+                processed=0,
+                total=pages.get(pk) or 1,
+                state=FileState.queued.value,
+            )
+
+    connection = transaction.get_connection()
+    if not hasattr(_dispatches, "pending"):
+        _dispatches.pending = weakref.WeakValueDictionary()
+    key = (connection.alias, tuple(connection.savepoint_ids))
+    dispatch = _dispatches.pending.get(key) if connection.in_atomic_block else None
+    if dispatch is not None:
+        dispatch.pks.update(dict.fromkeys(pks))
+        return
+    dispatch = ProcessingDispatch(pks)
+    if connection.in_atomic_block:
+        _dispatches.pending[key] = dispatch
+    transaction.on_commit(dispatch)
+
+
+def submit_batch(files: list[File], pages: dict[str, int] | None = None) -> str:
+    """Starts processing of bulk created files, which do not send File signals"""
+    batch_id = uuid.uuid4().hex
+    pks = [str(file.pk) for file in files]
+    set_key(f"batch-{batch_id}", pks, timeout=settings.CACHE_TTL)
+    schedule_processing(pks, pages)
+    return batch_id
+
+
+def get_batch_status(batch_id: str) -> dict:
+    pks = get_key(f"batch-{batch_id}")
+    if pks is None:
+        raise NotFound("given batch does not exist")
+    done = failed = processed = total = 0
+    for status in get_status_many(pks):
+        if status is None:
+            continue
+        if status["error"]:
+            failed += 1
+        elif status["features_loaded"]:
+            done += 1
+        processed += status["processed"]
+        total += status["total"]
     return {
-        "processed": created,
-        "total": total,
-        "features_loaded": features_loaded,
-        "error": error,
-        "error_description": error_description,
+        "files": len(pks),
+        "done": done,
+        "failed": failed,
+        "pages_processed": processed,
+        "pages_total": total,
     }
 
 
+def _supersede_title_update(pk: str, task_id: str = "") -> int:
+    """Takes the next title version, revokes the queued update of the previous one"""
+    version = next_title_version(pk)
+    previous = get_pipeline_status(pk).get("title_task")
+    update_status(pk, features_loaded=False, title_task=task_id)
+    if previous:
+        update_pdf_features.AsyncResult(previous).revoke()
+    return version
+
+
+def request_title_update(pk: str, target: str) -> int:
+    """
+    Queues matching of a new title, debounced by TITLE_UPDATE_DEBOUNCE seconds
+
+    Every request gets the next title version of the file. The previous
+    queued update is revoked, updates that already started stop at their
+    next check of the version, so only the latest title does the work.
+    """
+    task_id = uuid.uuid4().hex
+    version = _supersede_title_update(pk, task_id)
+    update_pdf_features.apply_async(
+        kwargs={"pk": pk, "target": target, "title_version": version},
+        countdown=settings.TITLE_UPDATE_DEBOUNCE,
+        task_id=task_id,
+    )
+    return version
+
+
+def find_title_candidate(file: File, target: str) -> dict | None:
+    """Title candidate equal to target with precomputed matches, if there is one"""
+    target = " ".join(target.split())
+    for candidate in file.title_candidates:
+        if " ".join(candidate["title"].split()) == target:
+            return candidate if "text_locations" in candidate else None
+    return None
+
+
+def apply_title_candidate(file: File, candidate: dict) -> int:
+    """
+    Switches file to the title candidate without rescanning the document
+
+    Matches are saved right away, only the highlighted pdf is made in
+    background. Pending updates of other titles are superseded as by
+    request_title_update.
+    """
+    pk = str(file.pk)
+    version = _supersede_title_update(pk)
+    File.objects.filter(pk=pk).update_content(
+        ideal_title=candidate["title"],
+        text_locations=candidate["text_locations"],
+        matched_pages=candidate["matched_pages"],
+        matches_count=len(candidate["text_locations"]),
+    )
+    file.refresh_from_db()
+    update_status(pk, matched=file.matched_pages, features_loaded=True)
+    transaction.on_commit(
+        lambda: highlight_pdf.apply_async(kwargs={"pk": pk, "title_version": version})
+    )
+    return version
+
+
 def extract_info(input_file: str):
     """
     Extracts file info
@@ -168,4 +357,3 @@ def process_data(
     # Save the output buffer to the output file
     with open(input_file, mode="wb") as f:
         f.write(output_buffer.getbuffer())
-
@@ -1,17 +1,42 @@
-from django.db.models.signals import pre_save
+from celery.signals import task_postrun, task_prerun, worker_process_init
+from django.conf import settings
+from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.core.cache import cache
 
+from dock_checker.common.metrics import flush_metrics
 from dock_checker.processor.models import File
-from .tasks import process_pdf
-
-
-@receiver(pre_save, sender=File)
-def file_on_create(sender, instance: File, **kwargs):
-    if instance.id and not instance.text_locations:
-        cache.set(f"{instance.id}-processed", 0)
-        cache.set(f"{instance.id}-total", 1)
-        process_pdf.apply_async(
-            kwargs={"pk": instance.pk},
-            countdown=1,
-        )
+from dock_checker.processor.services import schedule_processing
+from dock_checker.processor.status import get_status
+from ml import cache as ml_cache, metrics
+
+
+@receiver(post_save, sender=File)
+def file_on_create(sender, instance: File, created: bool, **kwargs):
+    if created:
+        schedule_processing([instance.pk])
+
+
+@task_prerun.connect
+def set_task_metrics_pages(task_id, task, kwargs=None, **extra):
+    pk = (kwargs or {}).get("pk")
+    if pk:
+        status = get_status(pk)
+        task.request.metrics_token = metrics.set_pages(status and status["total"])
+
+
+@task_postrun.connect
+def flush_task_metrics(task_id, task, **kwargs):
+    token = getattr(task.request, "metrics_token", None)
+    if token is not None:
+        metrics.reset_pages(token)
+    flush_metrics()
+
+
+@worker_process_init.connect
+def configure_result_cache(**kwargs):
+    ml_cache.configure(
+        maxsize=settings.ML_RESULT_CACHE_SIZE,
+        redis_url=settings.ML_RESULT_CACHE_URL or None,
+        ttl=settings.ML_RESULT_CACHE_TTL,
+        page_maxsize=settings.ML_PAGE_CACHE_SIZE,
+    )
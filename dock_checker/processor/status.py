@@ -0,0 +1,67 @@
+from django.conf import settings
+
+from dock_checker.common.cache import (
+    get_fields,
+    get_fields_many,
+    incr_field,
+    set_fields,
+)
+
+# processing status of a file is kept in one redis hash, so it is
+# updated atomically and polled in one round trip. Clients see these fields,
+# the others are bookkeeping of the pipeline (stage joins, title versions)
+DEFAULT_STATUS = {
+    "processed": 0,
+    "total": 0,
+    "matched": 0,
+    "features_loaded": False,
+    "error": False,
+    "error_description": "",
+    "state": "queued",
+}
+
+
+def status_key(pk) -> str:
+    return f"{pk}-status"
+
+
+def update_status(pk, pipe=None, **fields):
+    """Sets given status fields, pass cache pipeline to batch updates of many files"""
+    if pipe is None:
+        set_fields(status_key(pk), fields, timeout=settings.CACHE_TTL)
+    else:
+        pipe.set_fields(status_key(pk), fields, timeout=settings.CACHE_TTL)
+
+
+def _public(fields: dict) -> dict | None:
+    if not fields:
+        return None
+    return {field: fields.get(field, value) for field, value in DEFAULT_STATUS.items()}
+
+
+def get_status(pk) -> dict | None:
+    """Status shown to clients with defaults for unset fields, None for unknown files"""
+    return _public(get_fields(status_key(pk)))
+
+
+def get_status_many(pks: list) -> list[dict | None]:
+    return [
+        _public(fields) for fields in get_fields_many([status_key(pk) for pk in pks])
+    ]
+
+
+def get_pipeline_status(pk) -> dict:
+    """Whole status with pipeline bookkeeping, empty for unknown files"""
+    fields = get_fields(status_key(pk))
+    return {**DEFAULT_STATUS, **fields} if fields else {}
+
+
+def next_title_version(pk) -> int:
+    """Starts a new title update of the file, older ones become superseded"""
+    return incr_field(status_key(pk), "title_version", timeout=settings.CACHE_TTL)
+
+
+def is_superseded(pk, title_version: int | None) -> bool:
+    """Whether a newer title update was requested, None is the initial pipeline"""
+    current = get_pipeline_status(pk).get("title_version", 0)
+    return current != (title_version or 0)
@@ -1,65 +1,147 @@
+import functools
 import os
 
 import shutil
-from io import BytesIO
-from time import sleep
+from hashlib import md5
+from time import monotonic, sleep
 
-import fitz
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
 from django.core.files import File
-from pdf2image import convert_from_path
-from django.core.cache import cache
-from pypdf import PdfReader
-
-from dock_checker.processor.models import File as FileModel, FileImage
-from ml.main import (
-    extract_test_features,
-    inference_models,
-    create_test_features,
-    get_matches,
+from django.core.files.base import ContentFile
+
+from dock_checker.common.cache import lock
+from dock_checker.processor.models import File as FileModel, FileImage, FileState
+from dock_checker.processor.status import (
+    get_pipeline_status,
+    is_superseded,
+    update_status,
 )
+from ml.analyzer import DocumentAnalyzer
+from ml.document import as_document, open_document
+from ml.metrics import timed
+
+# locks of crashed workers expire together with the task hard time limit
+TASK_LOCK_TIMEOUT = settings.CELERY_TASK_TIME_LIMIT
+# tasks redelivered after a worker was killed wait for its lock, it is kept
+# alive by the running task and expires this soon after its worker died
+TASK_LOCK_TTL = 60
+TASK_LOCK_RETRY_COUNTDOWN = 10
+
+
+@functools.cache
+def get_analyzer() -> DocumentAnalyzer:
+    """Analyzer of the worker process, models are loaded by its first task"""
+    return DocumentAnalyzer(
+        checkpoint="ml/checkpoints/models.pkl",
+        candidates=settings.TITLE_CANDIDATES,
+        max_memory=settings.PDF_EXTRACTION_MAX_MEMORY,
+        align=settings.PDF_MATCHING_ALIGN_WORDS,
+        cascade=settings.TITLE_CASCADE,
+        layout=settings.PDF_LAYOUT_BACKEND,
+    )
+
+
+def open_file(file: FileModel):
+    """Handle of the uploaded pdf with the layout backend of the analyzer"""
+    return open_document(file.file.path, get_analyzer().layout)
+
+
+def set_state(pk: str, state: str, only_from: list[str] | None = None) -> bool:
+    """Moves file to state, if it is in one of only_from states, returns if it did"""
+    files = FileModel.objects.filter(pk=pk)
+    if only_from is not None:
+        files = files.filter(state__in=only_from)
+    if not files.update_content(state=state):
+        return False
+    update_status(pk, state=str(state))
+    return True
+
+
+def fail_file(pk: str, description: str):
+    update_status(pk, error=True, error_description=description, features_loaded=True)
+    set_state(pk, FileState.failed)
+
+
+def fails_file(task):
+    """Moves the file to failed when the wrapped pipeline task raises"""
+
+    @functools.wraps(task)
+    def wrapper(pk: str, *args, **kwargs):
+        try:
+            return task(pk, *args, **kwargs)
+        except Exception as e:
+            fail_file(pk, repr(e))
+            raise
+
+    return wrapper
+
+
+@shared_task
+def finish_stage(pk: str, stage: str):
+    """
+    Joins matching and rendering, which run in parallel
+
+    State is extracting until matches are found, then rendering until all
+    pages are stored, then done, whichever of the two finishes first.
+    Called inline by the stage that finished, if the other one holds the
+    state lock for too long the join is retried in a new task.
+    """
+    with lock(
+        f"state-{pk}", timeout=60, blocking=True, blocking_timeout=30
+    ) as acquired:
+        if not acquired:
+            finish_stage.apply_async(kwargs={"pk": pk, "stage": stage}, countdown=1)
+            return pk
+        update_status(pk, **{f"{stage}_done": True})
+        status = get_pipeline_status(pk)
+        if status.get("matching_done") and status.get("rendering_done"):
+            set_state(pk, FileState.done, [FileState.extracting, FileState.rendering])
+        elif stage == "matching":
+            set_state(pk, FileState.rendering, [FileState.extracting])
+    return pk
 
 
 @shared_task
+@fails_file
 def process_pdf(pk: str):
+    # only the first of duplicate submissions starts the pipeline
+    if not set_state(pk, FileState.extracting, [FileState.queued]):
+        return pk
     file = FileModel.objects.get(pk=pk)
-    reader = PdfReader(file.file.path)
-    cache.set(f"{pk}-total", len(reader.pages))
-    cache.set(f"{pk}-features_loaded", False)
-    cache.set(f"{pk}-processed", 1)
+    with timed("page_count"), open_document(file.file.path) as document:
+        total = document.page_count
+    update_status(pk, total=total, features_loaded=False, processed=1, matched=0)
     extract_pdf_features.apply_async(kwargs={"pk": pk})
     return pk
 
 
 @shared_task
+@fails_file
 def extract_pdf_features(pk: str):
-    file = FileModel.objects.get(pk=pk)
-    data, status = extract_test_features(file.file.path)
-    if not status:
-        print(data)
-        cache.set(f"{pk}-error", True)
-        cache.set(f"{pk}-error_description", data)
-    else:
-        # TODO: create new file for download
-        data = create_test_features(data)
-        _, target = inference_models("ml/checkpoints/models.pkl", data)
-        text_locations = get_matches(file.file.path, target)
-        file.ideal_title = target
-        file.text_locations = text_locations
-
-        pdfDoc = fitz.open(file.file.path)
-        for loc in text_locations:
-            page = pdfDoc[loc["page"] - 1]
-            matching_val_area = page.search_for(loc["raw_text"])
-            for rect in matching_val_area:
-                page.add_highlight_annot(rect)
-        output_buffer = BytesIO()
-        pdfDoc.close()
-        with open(file.file.path, mode="wb") as f:
-            f.write(output_buffer.getbuffer())
-
-        file.save()
-    cache.set(f"{pk}-features_loaded", True)
+    with lock(f"extract-{pk}", timeout=TASK_LOCK_TIMEOUT) as acquired:
+        file = FileModel.objects.get(pk=pk)
+        if (
+            not acquired
+            or file.state != FileState.extracting
+            or get_pipeline_status(pk).get("extracted")
+        ):
+            return pk
+        titles = get_analyzer().suggest_titles(file.file.path)
+        if titles["error"] is not None:
+            fail_file(pk, titles["error"])
+        else:
+            FileModel.objects.filter(pk=pk).update_content(
+                title_candidates=titles["candidates"]
+            )
+            match_pdf.apply_async(
+                kwargs={"pk": pk, "target": titles["title"], "highlight": True}
+            )
+            match_title_candidates.apply_async(
+                kwargs={"pk": pk}, priority=settings.TITLE_CANDIDATES_PRIORITY
+            )
+        update_status(pk, extracted=True)
     split_pdf_into_images.apply_async(kwargs={"pk": pk})
     load_pdf.apply_async(kwargs={"pk": pk})
     # create_processed_pdf.apply_async(kwargs={"pk": pk})
@@ -67,21 +149,206 @@ def extract_pdf_features(pk: str):
 
 
 @shared_task
-def update_pdf_features(pk: str, target: str):
+@fails_file
+def update_pdf_features(pk: str, target: str, title_version: int | None = None):
+    if is_superseded(pk, title_version):
+        return pk
+    # validity of the document does not depend on the title, it was decided
+    # by extract_pdf_features and page texts are cached by iter_matches
+    state = FileModel.objects.values_list("state", flat=True).get(pk=pk)
+    update_status(pk, features_loaded=False)
+    if state == FileState.failed:
+        update_status(pk, error=True, features_loaded=True)
+    else:
+        match_pdf.apply_async(
+            kwargs={"pk": pk, "target": target, "title_version": title_version}
+        )
+    return pk
+
+
+def save_matches(
+    pk: str, target: str, text_locations: list, matched_pages: int, current: str | None
+) -> bool:
+    """
+    Saves matches of target, returns False if the title was changed meanwhile
+
+    current is the title the run read from the file, it is target for all
+    but the first save of a new title. Matches of a run superseded by a
+    title update never overwrite the ones of the new title.
+    """
+    # queryset update, so partial results do not go through File signals
+    with timed("db"):
+        saved = FileModel.objects.filter(pk=pk, ideal_title=current).update_content(
+            ideal_title=target,
+            text_locations=text_locations,
+            matched_pages=matched_pages,
+            matches_count=len(text_locations),
+        )
+    if saved:
+        update_status(pk, matched=matched_pages)
+    return bool(saved)
+
+
+def highlight_matches(file: FileModel, document=None):
+    """Saves the pdf with highlighted matches, document is its open handle if any"""
+    with timed("highlight"), as_document(document or file.file.path) as handle:
+        highlighted = handle.highlight(file.text_locations)
+    previous = file.processed_file.name
+    with timed("storage"):
+        file.processed_file.save(f"{file.pk}.pdf", ContentFile(highlighted), save=False)
+    # every run deletes the pdf it replaced, also when another one saved meanwhile
+    files = FileModel.objects.filter(pk=file.pk)
+    while not files.filter(processed_file=previous).update_content(
+        processed_file=file.processed_file.name
+    ):
+        previous = files.values_list("processed_file", flat=True).get()
+    if previous:
+        file.processed_file.storage.delete(previous)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+@fails_file
+def match_pdf(
+    pk: str,
+    target: str,
+    first_page: int = 1,
+    highlight: bool = False,
+    title_version: int | None = None,
+):
+    """
+    Searches target in document in checkpointed chunks
+
+    Partial text_locations are saved every PDF_MATCHING_CHECKPOINT_PAGES pages,
+    so they are visible while the rest is processed. After PDF_MATCHING_CHUNK_TIME
+    seconds or on soft time limit the task continues from the next page in a new
+    one, task redelivered after worker restart resumes from the last checkpoint.
+    Duplicates for the same title wait for the running one and continue after
+    its checkpoint, runs superseded by a newer title update stop at the next one.
+    """
+    kwargs = {
+        "pk": pk,
+        "target": target,
+        "first_page": first_page,
+        "highlight": highlight,
+        "title_version": title_version,
+    }
+    key = md5(target.encode()).hexdigest()
+    with lock(f"match-{pk}-{key}", timeout=TASK_LOCK_TTL, keep_alive=True) as acquired:
+        if not acquired:
+            match_pdf.apply_async(kwargs=kwargs, countdown=TASK_LOCK_RETRY_COUNTDOWN)
+            return pk
+        if is_superseded(pk, title_version):
+            return pk
+        next_page = _match_pdf(pk, target, first_page, highlight, title_version)
+    # queued after the lock is released, a worker taking the continuation
+    # right away would otherwise find it held and wait for nothing
+    if next_page is not None:
+        match_pdf.apply_async(kwargs={**kwargs, "first_page": next_page})
+    return pk
+
+
+def _match_pdf(
+    pk: str, target: str, first_page: int, highlight: bool, title_version: int | None
+) -> int | None:
+    """Matches a chunk of pages, returns the page to continue from if not finished"""
     file = FileModel.objects.get(pk=pk)
-    cache.set(f"{pk}-features_loaded", False)
-    data, status = extract_test_features(file.file.path)
-    if not status:
-        print(data)
-        cache.set(f"{pk}-error", True)
-        cache.set(f"{pk}-error_description", data)
+    # highlighted pdf is made by the first run that completes
+    highlight = highlight or not file.processed_file
+    if file.ideal_title == target:
+        first_page = max(first_page, file.matched_pages + 1)
+        text_locations = [
+            loc for loc in file.text_locations if loc["page"] < first_page
+        ]
+    elif first_page > 1:
+        # title was changed, matches for the old one are not needed anymore
+        return None
     else:
-        # TODO: create new file for download
-        text_locations = get_matches(file.file.path, target)
-        file.ideal_title = target
-        file.text_locations = text_locations
-        file.save()
-    cache.set(f"{pk}-features_loaded", True)
+        text_locations = []
+    page = first_page - 1
+    if is_superseded(pk, title_version) or not save_matches(
+        pk, target, text_locations, page, file.ideal_title
+    ):
+        return None
+
+    deadline = monotonic() + settings.PDF_MATCHING_CHUNK_TIME
+    # matching and highlighting share one parsed document
+    with open_file(file) as document:
+        try:
+            # titles of uploaded files are corrected and their candidates
+            # matched, so page texts are kept for the next match
+            for page, matches in get_analyzer().iter_matches(
+                document, target, first_page=first_page, cache_pages=True
+            ):
+                text_locations += matches
+                if monotonic() > deadline:
+                    break
+                if page % settings.PDF_MATCHING_CHECKPOINT_PAGES == 0:
+                    if is_superseded(pk, title_version) or not save_matches(
+                        pk, target, text_locations, page, target
+                    ):
+                        return None
+            else:
+                if is_superseded(pk, title_version) or not save_matches(
+                    pk, target, text_locations, page, target
+                ):
+                    return None
+                if highlight:
+                    file.refresh_from_db()
+                    highlight_matches(file, document)
+                update_status(pk, features_loaded=True)
+                finish_stage(pk, "matching")
+                return None
+        except SoftTimeLimitExceeded:
+            pass
+
+    if is_superseded(pk, title_version) or not save_matches(
+        pk, target, text_locations, page, target
+    ):
+        return None
+    return page + 1
+
+
+@shared_task
+def match_title_candidates(pk: str):
+    """
+    Precomputes matches of every title candidate, so switching to one is instant
+
+    Runs at TITLE_CANDIDATES_PRIORITY behind the pipelines of other files.
+    Page texts are cached by the first pass, the other candidates only
+    compute their distances. Each candidate is saved once all pages are
+    matched, ones left on time limit are matched on request as usual.
+    """
+    with lock(f"candidates-{pk}", timeout=TASK_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            return pk
+        file = FileModel.objects.get(pk=pk)
+        candidates = file.title_candidates
+        try:
+            with open_file(file) as document:
+                for candidate in candidates:
+                    if "text_locations" in candidate:
+                        continue
+                    text_locations, page = [], 0
+                    for page, matches in get_analyzer().iter_matches(
+                        document, candidate["title"], cache_pages=True
+                    ):
+                        text_locations += matches
+                    candidate.update(text_locations=text_locations, matched_pages=page)
+                    # not shown to clients until chosen, so the version stays
+                    FileModel.objects.filter(pk=pk).update(title_candidates=candidates)
+        except SoftTimeLimitExceeded:
+            pass
+    return pk
+
+
+@shared_task
+@fails_file
+def highlight_pdf(pk: str, title_version: int | None = None):
+    """Highlights matches of a title that were saved without match_pdf"""
+    if is_superseded(pk, title_version):
+        return pk
+    highlight_matches(FileModel.objects.get(pk=pk))
+    finish_stage(pk, "matching")
     return pk
 
 
@@ -97,11 +364,37 @@ def update_pdf_features(pk: str, target: str):
 #     os.remove(f_path)
 
 
-@shared_task
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+@fails_file
 def split_pdf_into_images(pk: str):
-    file = FileModel.objects.get(pk=pk)
-    os.mkdir(str(pk))
-    convert_from_path(file.file.path, output_folder=str(pk), paths_only=True, fmt="png")
+    with lock(f"render-{pk}", timeout=TASK_LOCK_TTL, keep_alive=True) as acquired:
+        if not acquired:
+            # load_pdf waits for the pages, so the task is never dropped
+            split_pdf_into_images.apply_async(
+                kwargs={"pk": pk}, countdown=TASK_LOCK_RETRY_COUNTDOWN
+            )
+            return pk
+        if get_pipeline_status(pk).get("rendering_done"):
+            return pk
+        file = FileModel.objects.get(pk=pk)
+        # a run that crashed midway left some pages rendered or stored,
+        # only the rest is rendered, so load_pdf gets every page
+        done = set(file.images.values_list("order", flat=True))
+        if os.path.isdir(str(pk)):
+            done.update(
+                int(name.split("-")[-1].split(".")[0]) for name in os.listdir(str(pk))
+            )
+        os.makedirs(str(pk), exist_ok=True)
+        with timed("render"), open_document(file.file.path) as document:
+            for number in range(1, document.page_count + 1):
+                if number in done:
+                    continue
+                # pages appear in the folder complete, load_pdf stores them
+                # while the next ones are rendered
+                partial = f"{pk}.partial.png"
+                with open(partial, "wb") as f:
+                    f.write(document.render(number))
+                os.replace(partial, os.path.join(str(pk), f"page-{number}.png"))
     return pk
 
 
@@ -121,29 +414,41 @@ def get_file(pk: str, number: int):
 
 
 @shared_task
+@fails_file
 def load_pdf(pk: str):
+    with lock(f"load-{pk}", timeout=TASK_LOCK_TIMEOUT) as acquired:
+        if not acquired or get_pipeline_status(pk).get("rendering_done"):
+            return pk
+        if not _load_pdf(pk):
+            load_pdf.apply_async(
+                kwargs={"pk": pk},
+                countdown=1,
+            )
+            return pk
+    finish_stage(pk, "rendering")
+    return pk
+
+
+def _load_pdf(pk: str) -> bool:
+    """Stores rendered pages, returns False when it has to wait for more"""
     file = FileModel.objects.get(pk=pk)
     if not os.path.isdir(str(pk)):
-        load_pdf.apply_async(
-            kwargs={"pk": pk},
-            countdown=1,
-        )
-        return
+        return False
 
-    for i in range(cache.get(f"{pk}-processed"), cache.get(f"{pk}-total") + 1):
-        cache.set(f"{pk}-processed", i)
+    status = get_pipeline_status(pk)
+    stored = set(file.images.values_list("order", flat=True))
+    for i in range(status["processed"], status["total"] + 1):
+        update_status(pk, processed=i)
+        if i in stored:
+            continue
         f_path = get_file(pk, i)
         if f_path:
-            with open(str(pk) + "/" + f_path, "rb") as f:
+            with open(str(pk) + "/" + f_path, "rb") as f, timed("storage"):
                 FileImage.objects.create(
                     image=File(f, name=f"{pk}-{i}.png"), file=file, order=i
                 )
-                print(i)
+                FileModel.objects.filter(pk=pk).update_content()
         else:
-            load_pdf.apply_async(
-                kwargs={"pk": pk},
-                countdown=1,
-            )
-            return
-    shutil.rmtree(str(pk))
-    return pk
+            return False
+    shutil.rmtree(str(pk), ignore_errors=True)
+    return True
@@ -0,0 +1,232 @@
+import hashlib
+import os
+import re
+import uuid
+import zipfile
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from dock_checker.common.cache import get_key, set_key
+
+# page objects of uncompressed pdfs, pages inside object streams are not seen
+PAGE_OBJECT = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+PAGE_OBJECT_TAIL = 32
+CHUNKED_UPLOAD_TTL = 24 * 60 * 60
+# a chunk is written and the last one hashed while the upload is locked
+CHUNKED_UPLOAD_LOCK_TTL = 10 * 60
+
+
+class StoredUploadedFile(UploadedFile):
+    """Upload that is already written to its place in default storage"""
+
+    def __init__(self, storage_name, name, size, content_type, sha256, pages):
+        super().__init__(name=name, content_type=content_type, size=size)
+        self.storage_name = storage_name
+        self.sha256 = sha256
+        self.pages = pages
+
+    def open(self, mode="rb"):
+        self.file = default_storage.open(self.storage_name, mode)
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class PdfDigest:
+    """sha256 and page count of pdf bytes fed in order"""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.pages = 0
+        self._tail = b""
+
+    def update(self, data: bytes):
+        self.sha256.update(data)
+        # keep the end of previous chunk to catch markers split between chunks
+        window = self._tail + data
+        self.pages += sum(
+            1 for match in PAGE_OBJECT.finditer(window) if match.end() > len(self._tail)
+        )
+        self._tail = window[-PAGE_OBJECT_TAIL:]
+
+
+class PdfStream:
+    """Writes pdf to storage path, hashing it and counting pages on the fly"""
+
+    def __init__(self, storage_name: str, mode: str = "xb"):
+        self.storage_name = storage_name
+        path = default_storage.path(storage_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, mode)
+        self.digest = PdfDigest()
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.digest.update(data)
+
+    def close(self):
+        self.file.close()
+
+
+def reserve_upload_name(file_name: str) -> str:
+    from dock_checker.processor.models import File
+
+    field = File._meta.get_field("file")
+    return default_storage.get_available_name(field.generate_filename(None, file_name))
+
+
+def open_pdf_stream(file_name: str) -> PdfStream:
+    while True:
+        try:
+            return PdfStream(reserve_upload_name(file_name))
+        except FileExistsError:
+            # name was taken by a concurrent upload, pick the next one
+            continue
+
+
+class StreamingPdfUploadHandler(FileUploadHandler):
+    """
+    Streams uploaded pdf straight to its final storage location
+
+    Nothing is buffered in memory or temp files, sha256 and an estimate of
+    the page count are computed while the chunks arrive.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.stream = None
+        if self.file_name.lower().endswith(".pdf"):
+            self.stream = open_pdf_stream(self.file_name)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.stream is None:
+            # not a pdf, leave it to the default handlers and validation
+            return raw_data
+        self.stream.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.stream is None:
+            return None
+        self.stream.close()
+        return StoredUploadedFile(
+            self.stream.storage_name,
+            self.file_name,
+            file_size,
+            self.content_type,
+            self.stream.digest.sha256.hexdigest(),
+            self.stream.digest.pages,
+        )
+
+    def upload_interrupted(self):
+        if getattr(self, "stream", None) is not None:
+            self.stream.close()
+            default_storage.delete(self.stream.storage_name)
+
+
+def store_pdf(file_name: str, source, chunk_size: int = 1024 * 1024):
+    """Copies file like object to storage in chunks, as the upload handler does"""
+    stream = open_pdf_stream(file_name)
+    size = 0
+    try:
+        while chunk := source.read(chunk_size):
+            stream.write(chunk)
+            size += len(chunk)
+    except BaseException:
+        stream.close()
+        default_storage.delete(stream.storage_name)
+        raise
+    stream.close()
+    return StoredUploadedFile(
+        stream.storage_name,
+        file_name,
+        size,
+        "application/pdf",
+        stream.digest.sha256.hexdigest(),
+        stream.digest.pages,
+    )
+
+
+def discard_uploads(uploads):
+    """Removes already stored uploads of a failed request"""
+    for upload in uploads:
+        if isinstance(upload, StoredUploadedFile):
+            default_storage.delete(upload.storage_name)
+
+
+def iter_zip_pdfs(archive: zipfile.ZipFile):
+    """Unpacks pdfs from archive one by one, members are never read whole"""
+    for info in archive.infolist():
+        file_name = os.path.basename(info.filename)
+        if (
+            info.is_dir()
+            or info.filename.startswith("__MACOSX/")
+            or not file_name.lower().endswith(".pdf")
+        ):
+            continue
+        with archive.open(info) as source:
+            yield store_pdf(file_name, source)
+
+
+def create_chunked_upload(file_name: str, size: int) -> dict:
+    stream = open_pdf_stream(file_name)
+    stream.close()
+    upload = {
+        "id": uuid.uuid4().hex,
+        "name": file_name,
+        "size": size,
+        "storage_name": stream.storage_name,
+    }
+    set_key(f"upload-{upload['id']}", upload, timeout=CHUNKED_UPLOAD_TTL)
+    return upload
+
+
+def get_chunked_upload(upload_id: str) -> dict | None:
+    upload = get_key(f"upload-{upload_id}")
+    if upload is not None:
+        upload["offset"] = default_storage.size(upload["storage_name"])
+    return upload
+
+
+def write_chunk(upload: dict, stream, length: int, chunk_size: int = 64 * 1024) -> int:
+    """Appends up to length bytes of request body to the upload, returns new offset"""
+    with open(default_storage.path(upload["storage_name"]), "ab") as f:
+        while length > 0 and (chunk := stream.read(min(chunk_size, length))):
+            f.write(chunk)
+            length -= len(chunk)
+    return default_storage.size(upload["storage_name"])
+
+
+def complete_chunked_upload(upload: dict) -> StoredUploadedFile:
+    """
+    Hashes assembled file in one pass
+
+    Chunks may be written by different web workers, so the digest can't be
+    carried between requests and is computed once the last byte arrived.
+    """
+    digest = PdfDigest()
+    with default_storage.open(upload["storage_name"], "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return StoredUploadedFile(
+        upload["storage_name"],
+        upload["name"],
+        upload["size"],
+        "application/pdf",
+        digest.sha256.hexdigest(),
+        digest.pages,
+    )
+
+
+def finish_chunked_upload(upload: dict, file_pk):
+    """Keeps the upload with its created file, so a retried last chunk gets it"""
+    upload = {key: value for key, value in upload.items() if key != "offset"}
+    set_key(
+        f"upload-{upload['id']}",
+        {**upload, "file": str(file_pk)},
+        timeout=CHUNKED_UPLOAD_TTL,
+    )
@@ -0,0 +1,33 @@
+import zipfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+
+def validate_zip(value):
+    """
+    Checks that uploaded file is a zip archive within the bulk upload limits
+
+    Reads only its central directory, zipfile never inflates a member past
+    the size recorded there, so the limits bound what unpacking writes.
+    """
+    position = value.tell()
+    try:
+        if not zipfile.is_zipfile(value):
+            raise ValidationError("file is not a zip archive")
+        value.seek(position)
+        with zipfile.ZipFile(value) as archive:
+            members = archive.infolist()
+    except zipfile.BadZipFile as e:
+        raise ValidationError(f"broken archive: {e}")
+    finally:
+        value.seek(position)
+    if len(members) > settings.BULK_UPLOAD_MAX_ZIP_MEMBERS:
+        raise ValidationError(
+            f"archive has more than {settings.BULK_UPLOAD_MAX_ZIP_MEMBERS} files"
+        )
+    if sum(info.file_size for info in members) > settings.BULK_UPLOAD_MAX_ZIP_SIZE:
+        raise ValidationError(
+            f"archive unpacks to more than {settings.BULK_UPLOAD_MAX_ZIP_SIZE} bytes"
+        )
+    return value
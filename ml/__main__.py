@@ -0,0 +1,12 @@
+"""
+Processes pdfs without django or celery, see ml.batch
+
+    python -m ml data/*.pdf -o results.jsonl
+    python -m ml data/ -o results.parquet --workers 8
+"""
+import sys
+
+from ml.batch import main
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import io
+import os
+import time
+
+from ml import main
+from ml.document import DocumentHandle, as_document
+from ml.ensemble import load_ensemble
+
+SOURCES = (str, os.PathLike, io.BytesIO, bytes, bytearray, memoryview, DocumentHandle)
+
+
+class DocumentAnalyzer:
+    """
+    Title detection and matching of documents with resources kept warm
+
+    The model ensemble is loaded once and, as the nlp pipeline and the
+    result cache, shared by every document the analyzer sees, so a worker
+    handles many documents without setup costs. Documents are paths, pdf
+    bytes or handles of ml.document, analyze opens a document once for
+    all its stages, layout is the page text backend of matching. Results
+    are dicts of path, error, title, candidates, pages, matched_pages,
+    matches and seconds, path is None for bytes.
+
+        analyzer = DocumentAnalyzer()
+        result = analyzer.analyze("some.pdf")
+        result = analyzer.rematch(result, "Corrected title")
+        for result in analyzer.analyze_many(paths):
+            ...
+    """
+
+    def __init__(
+        self,
+        checkpoint: str = "ml/checkpoints/models.pkl",
+        candidates: int = 5,
+        max_memory: int | None = None,
+        align: bool = False,
+        cascade: bool = True,
+        layout: str = "pdfminer",
+    ):
+        self.checkpoint = checkpoint
+        # loaded before the first document, score_titles reuses it
+        load_ensemble(checkpoint)
+        self.candidates = candidates
+        self.max_memory = max_memory
+        self.align = align
+        self.cascade = cascade
+        self.layout = layout
+
+    def _source(self, document):
+        """Handle of the document, closed on exit unless a handle was given"""
+        if isinstance(document, dict):
+            if document["path"] is None:
+                raise ValueError("result of a bytes document, pass the bytes instead")
+            document = document["path"]
+        if not isinstance(document, SOURCES):
+            raise TypeError(f"expected a pdf path or bytes, got {type(document)}")
+        return as_document(document, self.layout)
+
+    def suggest_titles(self, document) -> dict:
+        """Most probable title and candidates, or the reason there is none"""
+        with self._source(document) as source:
+            data, status = main.extract_title_features(source)
+        if not status:
+            return {"error": data, "title": None, "candidates": []}
+        texts, features = data
+        scores = main.score_titles(self.checkpoint, features, cascade=self.cascade)
+        return {
+            "error": None,
+            "title": texts[scores.argmax()].strip(),
+            "candidates": main.title_candidates(texts, scores, self.candidates),
+        }
+
+    def iter_matches(
+        self, document, target: str, first_page: int = 1, cache_pages: bool = False
+    ):
+        """Yields (page number, matches on page), see ml.main.iter_matches"""
+        with self._source(document) as source:
+            yield from main.iter_matches(
+                source,
+                target,
+                max_memory=self.max_memory,
+                first_page=first_page,
+                align=self.align,
+                cache_pages=cache_pages,
+            )
+
+    def _result(self, document, start: float, **fields) -> dict:
+        path = document["path"] if isinstance(document, dict) else document
+        if isinstance(path, DocumentHandle):
+            path = path.path
+        if not isinstance(path, (str, os.PathLike)):
+            path = None
+        result = {"path": path and os.fspath(path), "error": None, "title": None}
+        result.update(candidates=[], pages=0, matched_pages=0, matches=[])
+        result.update(fields)
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    def _match(self, document, target: str, cache_pages: bool = False) -> dict:
+        matches, page = [], 0
+        for page, found in self.iter_matches(document, target, cache_pages=cache_pages):
+            matches += found
+        return {"pages": page, "matched_pages": page, "matches": matches}
+
+    def analyze(self, document) -> dict:
+        """Finds the title of the document and all its matches"""
+        start = time.perf_counter()
+        source = self._source(document)
+        try:
+            with source as handle:
+                titles = self.suggest_titles(handle)
+                if titles["error"] is not None:
+                    return self._result(document, start, **titles)
+                matches = self._match(handle, titles["title"])
+        except Exception as e:  # broken pdfs are reported in the result
+            return self._result(document, start, error=repr(e))
+        return self._result(document, start, **titles, **matches)
+
+    def rematch(self, document, target: str) -> dict:
+        """
+        Matches another title in an analyzed document
+
+        document is a result of analyze for path documents, or the path or
+        bytes again, results of bytes documents have no path and are
+        rejected with ValueError. Page texts are cached by the first rematch
+        of a document, later ones only compute the distances to the new title.
+        """
+        start = time.perf_counter()
+        fields = {"title": target}
+        if isinstance(document, dict):
+            fields["candidates"] = document["candidates"]
+        matches = self._match(document, target, cache_pages=True)
+        return self._result(document, start, **fields, **matches)
+
+    def analyze_many(self, documents):
+        """Yields analyze results of documents one by one, in order"""
+        for document in documents:
+            yield self.analyze(document)
@@ -0,0 +1,282 @@
+"""
+Offline processing of many pdfs with a local process pool
+
+Every worker process analyzes its documents with one DocumentAnalyzer, as
+the celery workers do, and one record per document is streamed to a jsonl
+file or a parquet directory. Finished paths are appended to a checkpoint
+file after their record is written, a restarted run skips them, so a
+crash repeats at most the records in flight.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from tqdm import tqdm
+
+from ml.document import LAYOUT_BACKENDS
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+def add_arguments(parser):
+    """Options shared by python -m ml and manage.py process_pdfs"""
+    parser.add_argument("inputs", nargs="+", help="pdf files, directories or globs")
+    parser.add_argument(
+        "-o", "--output", required=True, help="*.jsonl file or *.parquet directory"
+    )
+    parser.add_argument("--checkpoint", default="ml/checkpoints/models.pkl")
+    parser.add_argument(
+        "--resume-file", help=f"finished paths, default is output + {CHECKPOINT_SUFFIX}"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--candidates", type=int, default=5, help="title candidates per document"
+    )
+    parser.add_argument(
+        "--max-memory", type=int, help="rss in MB after which pdfminer caches drop"
+    )
+    parser.add_argument(
+        "--align",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="pair matched words with the title by alignment",
+    )
+    parser.add_argument(
+        "--cascade",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="score with the first models only when the title is clear",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=LAYOUT_BACKENDS,
+        default="pdfminer",
+        help="page text backend of matching",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="records per parquet part file"
+    )
+
+
+def iter_pdf_paths(inputs):
+    """Pdf paths of files, directories (recursively) and glob patterns, once each"""
+    seen = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = sorted(glob.glob(os.path.join(item, "**", "*"), recursive=True))
+        elif os.path.exists(item):
+            paths = [item]
+        else:
+            paths = sorted(glob.glob(item, recursive=True))
+        for path in paths:
+            path = os.path.abspath(path)
+            if path.lower().endswith(".pdf") and os.path.isfile(path):
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+
+_analyzer = None
+
+
+def _init_worker(options: dict):
+    global _analyzer
+    from ml.analyzer import DocumentAnalyzer
+
+    # every process loads its resources once, before the first document
+    _analyzer = DocumentAnalyzer(**options)
+
+
+def _analyze(path: str) -> dict:
+    return _analyzer.analyze(path)
+
+
+class JsonlWriter:
+    def __init__(self, path: str):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, record: dict) -> list[dict]:
+        """Writes the record, returns records that are now on disk"""
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        return [record]
+
+    def close(self) -> list[dict]:
+        self.file.close()
+        return []
+
+
+class ParquetWriter:
+    """
+    Every batch of records is written as a complete part file of the directory
+
+    A part file is readable as soon as it is in place, so paths of its
+    records are checkpointed right after it. Parts are written under a
+    hidden name and renamed, readers of the directory never see half of
+    one. Nested candidates and matches are stored as json strings, so the
+    schema is the same for every part.
+    """
+
+    def __init__(self, path: str, batch_size: int):
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            raise RuntimeError("parquet output needs pyarrow, pip install pyarrow")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.run = time.time_ns()
+        self.parts = 0
+        self.batch_size = batch_size
+        self.records = []
+
+    def write(self, record: dict) -> list[dict]:
+        """Buffers the record, returns records that are now on disk"""
+        record = {
+            **record,
+            "candidates": json.dumps(record["candidates"], ensure_ascii=False),
+            "matches": json.dumps(record["matches"], ensure_ascii=False),
+        }
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self) -> list[dict]:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        records, self.records = self.records, []
+        if records:
+            self.parts += 1
+            name = f"part-{self.run}-{self.parts:05d}.parquet"
+            partial = os.path.join(self.path, f".{name}.partial")
+            table = pa.Table.from_pylist(records, schema=self.schema())
+            pq.write_table(table, partial)
+            os.replace(partial, os.path.join(self.path, name))
+        return records
+
+    @staticmethod
+    def schema():
+        import pyarrow as pa
+
+        return pa.schema(
+            [
+                ("path", pa.string()),
+                ("error", pa.string()),
+                ("title", pa.string()),
+                ("candidates", pa.string()),
+                ("pages", pa.int64()),
+                ("matched_pages", pa.int64()),
+                ("matches", pa.string()),
+                ("seconds", pa.float64()),
+            ]
+        )
+
+    def close(self) -> list[dict]:
+        return self.flush()
+
+
+def open_writer(output: str, batch_size: int):
+    if output.endswith(".parquet"):
+        return ParquetWriter(output, batch_size)
+    return JsonlWriter(output)
+
+
+def run_batch(
+    inputs,
+    output: str,
+    checkpoint: str = "ml/checkpoints/models.pkl",
+    resume_file: str | None = None,
+    workers: int | None = None,
+    candidates: int = 5,
+    max_memory: int | None = None,
+    align: bool = False,
+    cascade: bool = True,
+    layout: str = "pdfminer",
+    batch_size: int = 100,
+    log=sys.stderr,
+) -> dict:
+    """Processes pdfs that are not in the resume file yet, returns run totals"""
+    resume_file = resume_file or output.rstrip("/") + CHECKPOINT_SUFFIX
+    done = set()
+    if os.path.exists(resume_file):
+        with open(resume_file, encoding="utf-8") as f:
+            done = {line.rstrip("\n") for line in f}
+    paths = [path for path in iter_pdf_paths(inputs) if path not in done]
+    print(f"{len(paths)} documents to process, {len(done)} done before", file=log)
+
+    options = {
+        "checkpoint": os.path.abspath(checkpoint),
+        "candidates": candidates,
+        "max_memory": max_memory,
+        "align": align,
+        "cascade": cascade,
+        "layout": layout,
+    }
+    totals = {"documents": 0, "failed": 0, "pages": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    writer = open_writer(output, batch_size)
+    with open(resume_file, "a", encoding="utf-8") as resume:
+
+        def mark_done(records):
+            for record in records:
+                resume.write(record["path"] + "\n")
+                totals["documents"] += 1
+                totals["failed"] += record["error"] is not None
+                totals["pages"] += record["pages"]
+            resume.flush()
+
+        try:
+            # spawned workers do not inherit django or celery state of the parent
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(
+                workers, initializer=_init_worker, initargs=(options,)
+            ) as pool:
+                for record in tqdm(
+                    pool.imap_unordered(_analyze, paths), total=len(paths), file=log
+                ):
+                    mark_done(writer.write(record))
+        finally:
+            mark_done(writer.close())
+    totals["seconds"] = time.perf_counter() - start
+    return totals
+
+
+def report(totals: dict) -> str:
+    seconds = max(totals["seconds"], 1e-9)
+    return (
+        f"{totals['documents']} documents ({totals['failed']} failed), "
+        f"{totals['pages']} pages in {totals['seconds']:.1f} s: "
+        f"{totals['documents'] / seconds:.2f} documents/s, "
+        f"{totals['pages'] / seconds:.2f} pages/s"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ml")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    totals = run_batch(**options_from_args(vars(args)))
+    print(report(totals), file=sys.stderr)
+    return 0
+
+
+def options_from_args(args: dict) -> dict:
+    """run_batch keyword arguments of parsed add_arguments options"""
+    return {
+        "inputs": args["inputs"],
+        "output": args["output"],
+        "checkpoint": args["checkpoint"],
+        "resume_file": args["resume_file"],
+        "workers": args["workers"],
+        "candidates": args["candidates"],
+        "max_memory": args["max_memory"],
+        "align": args["align"],
+        "cascade": args["cascade"],
+        "layout": args["layout"],
+        "batch_size": args["batch_size"],
+    }
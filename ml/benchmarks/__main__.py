@@ -0,0 +1,396 @@
+"""
+Document pipeline benchmarks, no network or services needed
+
+    python -m ml.benchmarks --pages 1 10 50
+    python -m ml.benchmarks --pages 1 10 50 --save      # record new baseline
+    python -m ml.benchmarks --pages 1 10 50 --compare   # fail on regressions
+    python -m ml.benchmarks --pages 10 500 --memory     # peak rss of get_matches
+    python -m ml.benchmarks --parity                    # fast inference vs catboost
+
+Baselines are stored in ml/benchmarks/baseline.json and should be updated
+together with the change that moves them, so the diff shows up in review.
+They are recorded with the ru_core_news_sm model the service runs, matching
+time is mostly lemmatization and a blank pipeline would hide it.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from ml.benchmarks.pdfs import TITLE, TITLE_POSITIONS, make_pdf
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def stub_ensemble(path: str, size: int = 3) -> str:
+    """Tiny catboost ensemble with the same features as the real checkpoint"""
+    from catboost import CatBoostClassifier
+
+    from ml.main import FEATURE_COLUMNS as COLUMNS
+
+    rng = np.random.default_rng(0)
+    x = pd.DataFrame(rng.integers(0, 100, (200, len(COLUMNS))), columns=COLUMNS)
+    y = (x["rank"] < 30).astype(int)
+    models = [
+        CatBoostClassifier(
+            iterations=10,
+            depth=2,
+            random_seed=i,
+            verbose=False,
+            thread_count=1,
+            allow_writing_files=False,
+        ).fit(x, y)
+        for i in range(size)
+    ]
+    with open(path, "wb") as f:
+        pickle.dump(models, f)
+    return path
+
+
+def reference_scores(checkpoint: str, df: pd.DataFrame) -> np.ndarray:
+    """Ensemble probabilities as catboost computes them, for parity checks"""
+    from catboost import Pool
+
+    from ml.main import FEATURE_COLUMNS as COLUMNS
+
+    with open(checkpoint, "rb") as f:
+        models = pickle.load(f)
+    pool = Pool(data=df[COLUMNS])
+    return np.mean([model.predict_proba(pool)[:, 1] for model in models], axis=0)
+
+
+def run_parity(args) -> int:
+    from ml.main import FEATURE_COLUMNS as COLUMNS
+    from ml.main import extract_title_features, score_titles
+
+    rng = np.random.default_rng(0)
+    worst = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        checkpoints = [stub_ensemble(os.path.join(workdir, "models.pkl"))]
+        if os.path.exists(args.checkpoint):
+            checkpoints.append(args.checkpoint)
+        matrices = [rng.integers(-10, 110, (rows, len(COLUMNS))) for rows in (1, 25)]
+        for pages in args.pages:
+            path = make_pdf(os.path.join(workdir, f"{pages}.pdf"), pages=pages)
+            data, status = extract_title_features(path)
+            if status:
+                matrices.append(data[1])
+        for checkpoint in checkpoints:
+            for x in matrices:
+                x = np.asarray(x, dtype=np.float32)
+                expected = reference_scores(
+                    checkpoint, pd.DataFrame(x, columns=COLUMNS)
+                )
+                difference = np.abs(score_titles(checkpoint, x) - expected).max()
+                worst = max(worst, difference)
+                print(
+                    f"score_titles[{checkpoint}, rows={len(x)}]: max diff {difference:.2e}"
+                )
+    if worst > args.max_score_difference:
+        print(
+            f"MISMATCH score_titles differs from catboost by {worst:.2e}, "
+            f"allowed {args.max_score_difference:.0e}",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+def measure(func, repeat: int, warm: bool = False) -> dict:
+    from ml.cache import get_cache, get_page_cache
+
+    times = []
+    for _ in range(repeat):
+        if not warm:
+            get_cache().clear()
+            get_page_cache().clear()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def _peak_rss_growth(path: str, max_memory: int | None, connection):
+    import psutil
+
+    from ml.main import get_matches
+
+    before = psutil.Process().memory_info().rss
+    get_matches(path, TITLE, max_memory=max_memory)
+    connection.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - before)
+
+
+def peak_rss_growth(path: str, max_memory: int | None = None) -> int:
+    """Peak rss growth of get_matches in bytes, measured in a forked process"""
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_peak_rss_growth, args=(path, max_memory, sender))
+    process.start()
+    growth = receiver.recv()
+    process.join()
+    return growth
+
+
+def run_memory(args) -> int:
+    growth = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for pages in args.pages:
+            path = make_pdf(
+                os.path.join(workdir, f"{pages}.pdf"),
+                pages=pages,
+                density=args.density,
+                fontfile=args.fontfile,
+            )
+            growth[pages] = peak_rss_growth(path)
+            print(f"get_matches[pages={pages}]: peak rss +{growth[pages] >> 20} MB")
+    spread = (max(growth.values()) - min(growth.values())) >> 20
+    if spread > args.max_memory_growth:
+        print(
+            f"REGRESSION peak rss grows by {spread} MB with page count, "
+            f"allowed {args.max_memory_growth} MB",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+def render_pages(path: str, output: str):
+    from ml.document import open_document
+
+    with open_document(path) as document:
+        for number in range(1, document.page_count + 1):
+            with open(os.path.join(output, f"page-{number}.png"), "wb") as f:
+                f.write(document.render(number))
+
+
+def pymupdf_matches(path: str, target: str):
+    from ml.document import open_document
+    from ml.main import get_matches
+
+    with open_document(path, layout="pymupdf") as document:
+        return get_matches(document, target)
+
+
+def page_count(path: str) -> int:
+    from ml.document import open_document
+
+    with open_document(path) as document:
+        return document.page_count
+
+
+def cases(path: str, checkpoint: str, workdir: str):
+    from ml.ensemble import load_ensemble
+    from ml.main import FEATURE_COLUMNS as COLUMNS
+    from ml.main import (
+        PageText,
+        calculate_distances,
+        compare_strings,
+        create_test_features,
+        extract_test_features,
+        extract_title_features,
+        get_matches,
+        inference_models,
+        iter_page_texts,
+        page_distances,
+        score_titles,
+    )
+
+    df, status = extract_test_features(path)
+    if not status:
+        raise RuntimeError(f"synthetic pdf rejected: {df}")
+    features = create_test_features(df.copy())
+    texts = list(df["text"])
+    window = TITLE.replace("parking", "parkin").replace("stage", "Stage")
+    # title sized windows over the first page, as get_matches compares them
+    size = len(TITLE.split())
+    windows = [" ".join(text.split()[:size]) for text in texts] * 10
+
+    yield "extract_test_features", lambda: extract_test_features(path)
+    yield "extract_title_features", lambda: extract_title_features(path)
+    yield "create_test_features", lambda: create_test_features(df.copy())
+    yield "inference_models", lambda: inference_models(checkpoint, features.copy())
+    yield "inference_models_catboost", lambda: reference_scores(checkpoint, features)
+    matrix = features[COLUMNS].to_numpy(dtype=np.float32)
+    yield "score_titles", lambda: score_titles(checkpoint, matrix)
+    # lower bound of the cascade, every page decided by the first model
+    ensemble = load_ensemble(checkpoint)
+    yield "score_titles_first_model", lambda: ensemble.predict_cascaded(matrix, 0)
+    yield "calculate_distances", lambda: calculate_distances(TITLE, texts)
+    _, boxes = next(iter_page_texts(path))
+    yield "page_distances", lambda: page_distances(TITLE, PageText(boxes))
+    yield "compare_strings", lambda: compare_strings(window, TITLE)
+    yield "compare_strings_windows", lambda: [
+        compare_strings(text, TITLE) for text in windows
+    ]
+    yield "compare_strings_aligned", lambda: [
+        compare_strings(text, TITLE, align=True) for text in windows
+    ]
+    yield "get_matches", lambda: get_matches(path, TITLE)
+    yield "get_matches_cached", lambda: get_matches(path, TITLE, cache_pages=True)
+    # new title on a document whose pages were already parsed
+    titles = iter(f"{TITLE} {i}" for i in range(1_000_000))
+    yield "get_matches_retitled_cached", lambda: get_matches(
+        path, next(titles), cache_pages=True
+    )
+    yield "get_matches_pymupdf", lambda: pymupdf_matches(path, TITLE)
+    yield "page_count", lambda: page_count(path)
+    yield "render", lambda: render_pages(path, tempfile.mkdtemp(dir=workdir))
+
+
+def run(args) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        checkpoint = stub_ensemble(os.path.join(workdir, "models.pkl"))
+        for pages in args.pages:
+            for position in args.title_position:
+                path = make_pdf(
+                    os.path.join(workdir, f"{pages}-{position}.pdf"),
+                    pages=pages,
+                    density=args.density,
+                    title_position=position,
+                    fontfile=args.fontfile,
+                )
+                params = f"pages={pages},density={args.density},title={position}"
+                for name, func in cases(path, checkpoint, workdir):
+                    if args.only and name not in args.only:
+                        continue
+                    try:
+                        result = measure(func, args.repeat, name.endswith("_cached"))
+                    except Exception as e:  # e.g. a missing optional dependency
+                        print(f"{name}[{params}]: skipped, {e!r}", file=sys.stderr)
+                        continue
+                    results[f"{name}[{params}]"] = result
+                    print(
+                        f"{name}[{params}]: "
+                        f"median {result['median'] * 1000:.2f} ms, "
+                        f"min {result['min'] * 1000:.2f} ms"
+                    )
+    return results
+
+
+def spacy_model() -> str:
+    """Name and version of the loaded spacy model, baselines of others differ"""
+    from ml.main import nlp
+
+    return f"{nlp.lang}_{nlp.meta['name']}-{nlp.meta['version']}"
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key]["median"], result["median"]
+        if after > before * (1 + tolerance):
+            regressions.append(
+                f"{key}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms "
+                f"(+{(after / before - 1) * 100:.0f}%)"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ml.benchmarks")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--density", type=int, default=20, help="lines per page")
+    parser.add_argument(
+        "--title-position", nargs="+", choices=TITLE_POSITIONS, default=["top"]
+    )
+    parser.add_argument("--fontfile", help="ttf font for non latin text")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", help="run only given cases")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="write results as baseline")
+    parser.add_argument("--compare", action="store_true", help="compare with baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%"
+    )
+    parser.add_argument(
+        "--memory", action="store_true", help="check that peak rss stays flat"
+    )
+    parser.add_argument(
+        "--max-memory-growth",
+        type=int,
+        default=64,
+        help="allowed peak rss difference between page counts, MB",
+    )
+    parser.add_argument(
+        "--parity", action="store_true", help="check fast inference against catboost"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default="ml/checkpoints/models.pkl",
+        help="real ensemble checked with --parity next to a stub one",
+    )
+    parser.add_argument("--max-score-difference", type=float, default=1e-9)
+    args = parser.parse_args(argv)
+
+    if args.memory:
+        return run_memory(args)
+    if args.parity:
+        return run_parity(args)
+
+    from ml.main import nlp
+
+    if args.save and "lemmatizer" not in nlp.pipe_names:
+        print(
+            f"spacy model {spacy_model()} has no lemmatizer, "
+            "install ru_core_news_sm to record a baseline",
+            file=sys.stderr,
+        )
+        return 1
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(
+                f"no baseline at {args.baseline}, record one with --save",
+                file=sys.stderr,
+            )
+            return 1
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("spacy_model") != spacy_model():
+            print(
+                f"baseline was recorded with spacy model "
+                f"{baseline.get('spacy_model')}, loaded one is {spacy_model()}",
+                file=sys.stderr,
+            )
+            return 1
+
+    results = run(args)
+
+    if args.compare:
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "machine": platform.platform(),
+                    "python": platform.python_version(),
+                    "spacy_model": spacy_model(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
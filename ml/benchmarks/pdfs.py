@@ -0,0 +1,84 @@
+import random
+
+import fitz
+
+WORDS = (
+    "project documentation object construction building residential complex "
+    "section volume part drawing scheme plan floor facade foundation roof wall "
+    "engineering network heating ventilation water supply sewerage power lighting "
+    "fire safety measures environment protection estimate calculation structure "
+    "concrete steel frame parking territory improvement landscaping district city "
+    "street house block stage reconstruction capital repair technical solution"
+).split()
+
+TITLE = "Residential complex with underground parking on Lenin street stage 2"
+TITLE_POSITIONS = ("top", "middle", "bottom")
+
+
+def _line(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _typo(rng: random.Random, text: str) -> str:
+    words = text.split()
+    i = rng.randrange(len(words))
+    words[i] = words[i][:-1] or words[i]
+    return " ".join(words)
+
+
+def make_pdf(
+    path: str,
+    pages: int = 10,
+    density: int = 20,
+    title: str = TITLE,
+    title_position: str = "top",
+    title_every: int = 5,
+    fontfile: str | None = None,
+    seed: int = 0,
+) -> str:
+    """
+    Writes synthetic project documentation pdf
+
+    density is the number of text lines per page, the title is placed on the first
+    page at title_position in bold and repeated with small typos every title_every
+    pages, so matching has something to find. Base14 fonts only cover latin text,
+    pass fontfile to use cyrillic titles.
+    """
+    rng = random.Random(seed)
+    doc = fitz.open()
+    regular, bold, italic = "helv", "hebo", "heit"
+    if fontfile:
+        regular = bold = italic = "custom"
+
+    for number in range(pages):
+        page = doc.new_page()
+        if fontfile:
+            page.insert_font(fontname="custom", fontfile=fontfile)
+        width, height = page.rect.width, page.rect.height
+        step = (height - 144) / max(density, 1)
+        title_line = None
+        if number == 0:
+            title_line = {
+                "top": 0,
+                "middle": density // 2,
+                "bottom": max(density - 1, 0),
+            }[title_position]
+        elif title_every and number % title_every == 0:
+            title_line = rng.randrange(max(density, 1))
+
+        for line in range(density):
+            point = fitz.Point(72, 72 + line * step)
+            if line == title_line:
+                text = title if number == 0 else _typo(rng, title)
+                page.insert_text(point, text, fontname=bold, fontsize=14)
+            else:
+                font = italic if rng.random() < 0.1 else regular
+                page.insert_text(
+                    point, _line(rng, rng.randint(6, 12)), fontname=font, fontsize=10
+                )
+        page.insert_text(
+            fitz.Point(width / 2, height - 36), str(number + 1), fontname=regular
+        )
+    doc.save(path)
+    doc.close()
+    return path
@@ -0,0 +1,129 @@
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+
+import redis
+
+MISSING = object()
+# part of every key, bump it with changes of matching code that change its
+# results (_closest_window, compare_strings, page boxes), so values computed
+# by older code are not served from redis until their ttl
+VERSION = 1
+
+
+class ResultCache:
+    """
+    Memoization of matching results shared between documents
+
+    Values live in a per process LRU and, when redis_url is given, in redis
+    with ttl. Values bigger than max_value_size bytes are kept only locally,
+    redis errors are ignored, the cache is never required for correctness.
+    Values are pickled, so the redis instance must be trusted as much as
+    the code, anyone able to write to it can run code in the workers.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 100_000,
+        redis_url: str | None = None,
+        ttl: int = 7 * 24 * 60 * 60,
+        max_value_size: int = 64 * 1024,
+        prefix: str = "ml-cache",
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_value_size = max_value_size
+        self.prefix = prefix
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, namespace: str, *parts) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            digest.update(repr(part).encode())
+            digest.update(b"\0")
+        return f"{self.prefix}:v{VERSION}:{namespace}:{digest.hexdigest()}"
+
+    def _get_local(self, key):
+        with self._lock:
+            value = self._local.get(key, MISSING)
+            if value is not MISSING:
+                self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._local[key] = value
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+    def get_many(self, keys: list[str]) -> dict:
+        """Returns found values, redis is asked once for all local misses"""
+        found = {}
+        misses = []
+        for key in keys:
+            value = self._get_local(key)
+            if value is MISSING:
+                misses.append(key)
+            else:
+                found[key] = value
+        if misses and self.redis is not None:
+            try:
+                values = self.redis.mget(misses)
+            except redis.RedisError:
+                values = []
+            for key, raw in zip(misses, values):
+                if raw is not None:
+                    found[key] = pickle.loads(raw)
+                    self._set_local(key, found[key])
+        return found
+
+    def set_many(self, items: dict):
+        for key, value in items.items():
+            self._set_local(key, value)
+        if not items or self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, value in items.items():
+                raw = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                if len(raw) <= self.max_value_size:
+                    pipe.set(key, raw, ex=self.ttl)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key, MISSING)
+
+    def set(self, key: str, value):
+        self.set_many({key: value})
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+
+result_cache = ResultCache()
+# page boxes are large and only reused when another title of the document is
+# matched, they are kept apart in a small LRU bounded by pages
+page_cache = ResultCache(maxsize=2_000)
+
+
+def configure(page_maxsize: int = 2_000, **kwargs):
+    """Replaces the module caches, e.g. to enable the redis tier in workers"""
+    global result_cache, page_cache
+    result_cache = ResultCache(**kwargs)
+    page_cache = ResultCache(**{**kwargs, "maxsize": page_maxsize})
+    return result_cache
+
+
+def get_cache() -> ResultCache:
+    return result_cache
+
+
+def get_page_cache() -> ResultCache:
+    return page_cache
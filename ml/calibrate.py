@@ -0,0 +1,102 @@
+"""
+Calibrates early exit margin of the title ensemble on a held-out set
+
+    python -m ml.calibrate held_out.csv
+    python -m ml.calibrate held_out.csv --checkpoint ml/checkpoints/models.pkl
+
+The csv has a row per first page box of every document, with the
+FEATURE_COLUMNS, the document in "file" and 1 in "label" for its title,
+as the labeled sets of the training notebook. The smallest margin that
+keeps title accuracy of the full ensemble is written next to the
+checkpoint, where score_titles(..., cascade=True) picks it up.
+"""
+import argparse
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from ml.ensemble import cascade_path, load_ensemble, title_margin
+
+
+def document_outcomes(ensemble, documents) -> tuple[np.ndarray, np.ndarray]:
+    """Margins and correctness of every document after each number of models"""
+    margins, correct = [], []
+    for x, labels in documents:
+        predictions = list(ensemble.iter_predictions(x))
+        margins.append([title_margin(scores) for scores in predictions])
+        correct.append([labels[scores.argmax()] == 1 for scores in predictions])
+    return np.array(margins), np.array(correct)
+
+
+def cascade_outcome(margins, correct, margin: float) -> tuple[float, float]:
+    """Accuracy and mean number of models used with given early exit margin"""
+    exits = margins[:, :-1] >= margin
+    # documents that never exit early are decided by the last model
+    used = np.where(exits.any(axis=1), exits.argmax(axis=1), margins.shape[1] - 1)
+    return correct[np.arange(len(used)), used].mean(), (used + 1).mean()
+
+
+def calibrate(margins, correct, max_accuracy_drop: float = 0) -> dict:
+    """
+    Smallest margin keeping accuracy of the full ensemble
+
+    Margins are lowered while every margin above also keeps the accuracy,
+    so a lucky gap on the held-out set does not decide the threshold.
+    """
+    full = correct[:, -1].mean()
+    chosen = {"margin": float("inf"), "accuracy": full, "models": margins.shape[1]}
+    for margin in np.unique(margins[:, :-1])[::-1]:
+        accuracy, models = cascade_outcome(margins, correct, margin)
+        if accuracy < full - max_accuracy_drop:
+            break
+        chosen = {"margin": float(margin), "accuracy": accuracy, "models": models}
+    return {**chosen, "full_accuracy": full, "documents": len(margins)}
+
+
+def load_documents(path: str) -> list[tuple[np.ndarray, np.ndarray]]:
+    from ml.main import FEATURE_COLUMNS
+
+    df = pd.read_csv(path)
+    return [
+        (
+            group[FEATURE_COLUMNS].to_numpy(dtype=np.float32),
+            group["label"].to_numpy(),
+        )
+        for _, group in df.groupby("file", sort=False)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ml.calibrate")
+    parser.add_argument("held_out", help="csv of labeled first page boxes")
+    parser.add_argument("--checkpoint", default="ml/checkpoints/models.pkl")
+    parser.add_argument(
+        "--max-accuracy-drop",
+        type=float,
+        default=0,
+        help="allowed accuracy loss against the full ensemble, 0.01 is 1%%",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="print the result, do not save it"
+    )
+    args = parser.parse_args(argv)
+
+    ensemble = load_ensemble(args.checkpoint)
+    margins, correct = document_outcomes(ensemble, load_documents(args.held_out))
+    result = calibrate(margins, correct, args.max_accuracy_drop)
+    print(
+        f"margin {result['margin']:.4f}: accuracy {result['accuracy']:.4f} "
+        f"(full ensemble {result['full_accuracy']:.4f}), "
+        f"{result['models']:.2f} of {len(ensemble.models)} models per document "
+        f"on {result['documents']} documents"
+    )
+    if not args.dry_run:
+        with open(cascade_path(args.checkpoint), "w") as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
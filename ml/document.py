@@ -0,0 +1,138 @@
+import hashlib
+import io
+import mmap
+import os
+from contextlib import contextmanager
+
+import fitz
+
+LAYOUT_BACKENDS = ("pdfminer", "pymupdf")
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable binary file over a memoryview, every reader has its own position"""
+
+    def __init__(self, buffer: memoryview):
+        self.buffer = buffer
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self.buffer[self.position : self.position + len(b)]
+        b[: len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class DocumentHandle:
+    """
+    One pdf opened once and shared by the pipeline stages
+
+    Files are memory mapped for pdfminer, which parses the mapping through
+    stream(). The page count, first page text, annotation and rendering are
+    served by one PyMuPDF document, opened from the path of files and from
+    a copy of in-memory sources, as PyMuPDF only takes bytes streams. layout
+    selects the backend of page text boxes used for matching, pdfminer
+    keeps boxes (and so matches) as they always were, pymupdf avoids the
+    second parser.
+    """
+
+    def __init__(self, source, layout: str = "pdfminer"):
+        if layout not in LAYOUT_BACKENDS:
+            raise ValueError(f"unknown layout backend {layout!r}")
+        self.layout = layout
+        self.path = None
+        self._file = self._mmap = None
+        self._fitz = None
+        if isinstance(source, (str, os.PathLike)):
+            self.path = os.path.abspath(source)
+            self._file = open(self.path, "rb")
+            stat = os.fstat(self._file.fileno())
+            self.key = (self.path, stat.st_size, stat.st_mtime_ns)
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self._mmap)
+        else:
+            if isinstance(source, io.BytesIO):
+                source = source.getbuffer()
+            self.buffer = memoryview(source)
+            self.key = ("sha256", hashlib.sha256(self.buffer).hexdigest())
+
+    def stream(self) -> BufferReader:
+        """New file object over the document, e.g. for pdfminer"""
+        return BufferReader(self.buffer)
+
+    @property
+    def fitz(self) -> fitz.Document:
+        if self._fitz is None:
+            if self.path is not None:
+                self._fitz = fitz.open(self.path)
+            else:
+                self._fitz = fitz.open(stream=bytes(self.buffer), filetype="pdf")
+        return self._fitz
+
+    @property
+    def page_count(self) -> int:
+        return self.fitz.page_count
+
+    def highlight(self, locations) -> bytes:
+        """
+        Pdf with highlighted raw_text of text_locations
+
+        Annotations stay on the shared PyMuPDF document, so highlight is
+        the last thing done with a handle.
+        """
+        for location in locations:
+            page = self.fitz[location["page"] - 1]
+            for rect in page.search_for(location["raw_text"]):
+                page.add_highlight_annot(rect)
+        return self.fitz.tobytes()
+
+    def render(self, number: int, dpi: int = 200) -> bytes:
+        """Png of page number, counted from 1"""
+        return self.fitz[number - 1].get_pixmap(dpi=dpi).tobytes("png")
+
+    def close(self):
+        if self._fitz is not None:
+            self._fitz.close()
+            self._fitz = None
+        self.buffer.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_document(source, layout: str = "pdfminer") -> DocumentHandle:
+    """Handle of a pdf path, bytes or io.BytesIO, close it or use it in with"""
+    return DocumentHandle(source, layout)
+
+
+@contextmanager
+def as_document(file, layout: str = "pdfminer"):
+    """Given handle as is, or a handle of path or bytes closed on exit"""
+    if isinstance(file, DocumentHandle):
+        yield file
+    else:
+        with open_document(file, layout) as document:
+            yield document
@@ -0,0 +1,139 @@
+import functools
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+
+class ObliviousEnsemble:
+    """
+    Averaged probabilities of catboost classifiers, evaluated with numpy
+
+    Symmetric trees of all models are exported once into flat arrays, so
+    scoring the few boxes of a page is a handful of vectorized operations
+    instead of a Pool and a predict_proba call per model. Models with
+    categorical features or other tree shapes are scored by catboost.
+    """
+
+    def __init__(self, models: list):
+        self.models = models
+        # early exit margin of predict_cascaded, set by ml.calibrate
+        self.margin = None
+        self.trees = None
+        try:
+            self.trees = [self._export(model) for model in models]
+        except (KeyError, ValueError):
+            self.trees = None
+
+    @staticmethod
+    def _export(model) -> tuple:
+        if model.get_cat_feature_indices():
+            raise ValueError("categorical features are not supported")
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "model.json")
+            model.save_model(path, format="json")
+            with open(path) as f:
+                dump = json.load(f)
+        trees = dump["oblivious_trees"]
+        for tree in trees:
+            # trees without splits are dumped with null
+            tree["splits"] = tree["splits"] or []
+        depth = max(len(tree["splits"]) for tree in trees)
+        features = np.zeros((len(trees), depth), dtype=np.intp)
+        # padded splits never fire, so short trees keep their leaf numbering
+        borders = np.full((len(trees), depth), np.inf, dtype=np.float32)
+        leaves = np.zeros((len(trees), 2**depth))
+        for i, tree in enumerate(trees):
+            for j, split in enumerate(tree["splits"]):
+                if split["split_type"] != "FloatFeature":
+                    raise ValueError(f"{split['split_type']} splits are not supported")
+                features[i, j] = split["float_feature_index"]
+                borders[i, j] = split["border"]
+            values = tree["leaf_values"]
+            if len(values) != 2 ** len(tree["splits"]):
+                raise ValueError("only one dimensional models are supported")
+            leaves[i, : len(values)] = values
+        scale, bias = dump.get("scale_and_bias", [1, [0]])
+        return features, borders, leaves, scale, bias[0]
+
+    def _raw(self, x: np.ndarray, trees: tuple) -> np.ndarray:
+        features, borders, leaves, scale, bias = trees
+        # leaf index bit j is set when the j-th split of the tree is passed
+        passed = x[:, features] > borders
+        index = passed @ (1 << np.arange(features.shape[1]))
+        return scale * leaves[np.arange(len(leaves)), index].sum(axis=1) + bias
+
+    def _probability(self, i: int, x: np.ndarray) -> np.ndarray:
+        if self.trees is None:
+            return self.models[i].predict(
+                x, prediction_type="Probability", thread_count=1
+            )[:, 1]
+        return 1 / (1 + np.exp(-self._raw(x, self.trees[i])))
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """Mean positive class probability of rows of float32 feature matrix"""
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        return np.mean(
+            [self._probability(i, x) for i in range(len(self.models))], axis=0
+        )
+
+    def iter_predictions(self, x: np.ndarray):
+        """Mean probabilities of the first 1, 2, ... models, each computed on demand"""
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        total = np.zeros(len(x))
+        for i in range(len(self.models)):
+            total = total + self._probability(i, x)
+            yield total / (i + 1)
+
+    def predict_cascaded(self, x: np.ndarray, margin: float) -> tuple[np.ndarray, int]:
+        """
+        Mean probabilities of as few models as needed, and how many were used
+
+        Scoring stops once the best row leads the runner-up by at least
+        margin, documents with an obvious title are decided by the first
+        model, unclear ones by the whole ensemble.
+        """
+        for used, scores in enumerate(self.iter_predictions(x), start=1):
+            if title_margin(scores) >= margin:
+                break
+        return scores, used
+
+
+def title_margin(scores: np.ndarray) -> float:
+    """Lead of the best score over the second one"""
+    if len(scores) < 2:
+        return float(scores.max(initial=0))
+    second, first = np.partition(scores, -2)[-2:]
+    return float(first - second)
+
+
+def cascade_path(checkpoint_name: str) -> str:
+    """Calibrated cascade margin of a checkpoint is kept next to it"""
+    return f"{checkpoint_name}.cascade.json"
+
+
+def _mtime_ns(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=4)
+def _load_ensemble(
+    path: str, mtime_ns: int, cascade_mtime_ns: int | None
+) -> ObliviousEnsemble:
+    with open(path, "rb") as f:
+        ensemble = ObliviousEnsemble(pickle.load(f))
+    if cascade_mtime_ns is not None:
+        with open(cascade_path(path)) as f:
+            ensemble.margin = json.load(f)["margin"]
+    return ensemble
+
+
+def load_ensemble(checkpoint_name: str) -> ObliviousEnsemble:
+    """Ensemble of a pickled list of models, loaded once per process and file version"""
+    path = os.path.abspath(checkpoint_name)
+    return _load_ensemble(path, _mtime_ns(path), _mtime_ns(cascade_path(path)))
@@ -1,22 +1,194 @@
+import bisect
+import gc
 import re
 import math
+import psutil
 import spacy
-import pickle
 import warnings
+import fitz
+from functools import lru_cache
 import Levenshtein
 import numpy as np
 import pandas as pd
 import Levenshtein as lev
 
-from catboost import Pool
-from pdfminer.high_level import extract_pages
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
 from tqdm import tqdm
-from pdfminer.layout import LTTextContainer, LTChar
+from pdfminer.layout import LAParams, LTTextContainer, LTChar
 
+from ml.cache import MISSING, get_cache, get_page_cache
+from ml.document import as_document
+from ml.ensemble import load_ensemble
+from ml.metrics import timed, timed_iter
 
-warnings.filterwarnings("ignore")
 
+warnings.filterwarnings("ignore")
 
+FEATURE_COLUMNS = [
+    "font",
+    "rank",
+    "rank_squares",
+    "bold_percentage",
+    "id_percentage",
+]
+
+
+def _release_caches(document, resources):
+    # pdfminer keeps every parsed object and font for the whole document
+    for cache in (
+        getattr(document, "_cached_objs", None),
+        getattr(document, "_parsed_objs", None),
+        getattr(resources, "_cached_fonts", None),
+    ):
+        if cache is not None:
+            cache.clear()
+    gc.collect()
+
+
+# pages parsed after a release of pdfminer caches before the next one
+RELEASE_INTERVAL = 32
+
+
+def iter_page_layouts(file, max_memory=None, first_page=1):
+    """
+    Yields pdfminer page layouts one by one, starting from first_page
+
+    Only the current layout is referenced, when process rss goes over
+    max_memory (in megabytes) pdfminer document caches are dropped. Freed
+    memory mostly stays with the process, so rss remains over the limit
+    and caches are dropped at most once per RELEASE_INTERVAL pages.
+    """
+    process = psutil.Process() if max_memory else None
+    released = -RELEASE_INTERVAL
+    with as_document(file) as handle:
+        document = PDFDocument(PDFParser(handle.stream()))
+        resources = PDFResourceManager()
+        device = PDFPageAggregator(resources, laparams=LAParams())
+        interpreter = PDFPageInterpreter(resources, device)
+        for number, page in enumerate(PDFPage.create_pages(document), start=1):
+            if number < first_page:
+                continue
+            interpreter.process_page(page)
+            page_layout = device.get_result()
+            yield page_layout
+            del page_layout
+            device.cur_item = device.result = None
+            if (
+                process
+                and number - released >= RELEASE_INTERVAL
+                and process.memory_info().rss > max_memory * 1024 * 1024
+            ):
+                _release_caches(document, resources)
+                released = number
+
+
+def _iter_pdfminer_page_texts(document, max_memory, first_page):
+    for page, page_layout in enumerate(
+        timed_iter("layout", iter_page_layouts(document, max_memory, first_page)),
+        start=first_page,
+    ):
+        _x1, _y1, _x2, _y2 = page_layout.bbox
+        boxes = []
+        for element in page_layout:
+            if isinstance(element, LTTextContainer):
+                x1, y1, x2, y2 = element.bbox
+                raw = element.get_text()
+                text = replace_multiple_spaces(raw.replace("\n", " ").strip())
+                if len(text) > 3:
+                    boxes.append(
+                        (
+                            text,
+                            raw,
+                            [x1 / _x2, y1 / _y2, (x2 - x1) / _x2, (y2 - y1) / _y2],
+                        )
+                    )
+        del page_layout
+        yield page, boxes
+
+
+def _iter_pymupdf_page_texts(document, first_page):
+    for page in range(first_page, document.page_count + 1):
+        with timed("layout"):
+            fitz_page = document.fitz[page - 1]
+            width, height = fitz_page.rect.width, fitz_page.rect.height
+            blocks = fitz_page.get_text("blocks")
+        boxes = []
+        for x1, y1, x2, y2, raw, _, kind in blocks:
+            text = replace_multiple_spaces(raw.replace("\n", " ").strip())
+            if kind == 0 and len(text) > 3:
+                # relative to the bottom left corner, as pdfminer boxes
+                coords = [x1 / width, 1 - y2 / height, (x2 - x1) / width]
+                boxes.append((text, raw, coords + [(y2 - y1) / height]))
+        yield page, boxes
+
+
+def iter_page_texts(file, max_memory=None, first_page=1):
+    """
+    Yields (page number, [(text, raw text, relative coords), ...]) per page
+
+    Boxes come from the layout backend of the document handle, pdfminer
+    for paths and bytes.
+    """
+    with as_document(file) as document:
+        if document.layout == "pymupdf":
+            yield from _iter_pymupdf_page_texts(document, first_page)
+        else:
+            yield from _iter_pdfminer_page_texts(document, max_memory, first_page)
+
+
+def iter_cached_page_texts(file, max_memory=None, first_page=1, batch=64):
+    """
+    iter_page_texts memoized per page in the page cache
+
+    Page boxes do not depend on the title, so matching another title of
+    the same document reads them from the cache and skips pdfminer. Pages
+    are parsed from the first one missing in the cache. Only for documents
+    that are matched again, the cache is bounded by pages, not documents.
+    """
+    with as_document(file) as handle:
+        yield from _iter_cached_page_texts(handle, max_memory, first_page, batch)
+
+
+def _iter_cached_page_texts(file, max_memory, first_page, batch):
+    cache = get_page_cache()
+    document = (file.key, file.layout)
+    pages = cache.get(cache.key("page_count", document))
+    page = first_page
+    while pages is not MISSING and page <= pages:
+        numbers = range(page, min(page + batch, pages + 1))
+        keys = [cache.key("page_texts", document, number) for number in numbers]
+        found = cache.get_many(keys)
+        for number, key in zip(numbers, keys):
+            if key not in found:
+                break
+            yield number, found[key]
+            page = number + 1
+        if len(found) < len(keys):
+            break
+    if pages is not MISSING and page > pages:
+        return
+
+    parsed = {}
+    last = None
+    try:
+        for last, boxes in iter_page_texts(file, max_memory, page):
+            parsed[cache.key("page_texts", document, last)] = boxes
+            if len(parsed) >= batch:
+                cache.set_many(parsed)
+                parsed = {}
+            yield last, boxes
+    finally:
+        # also keeps pages parsed before the consumer stopped, e.g. on deadline
+        cache.set_many(parsed)
+    if last is not None:
+        cache.set(cache.key("page_count", document), last)
+
+
+@timed("title_features")
 def extract_test_features(file):
     texts = []
     fonts = []
@@ -24,7 +196,7 @@ def extract_test_features(file):
     ids = []
     coords = []
     relative_coords = []
-    for page_layout in extract_pages(file):
+    for page_layout in timed_iter("layout", iter_page_layouts(file)):
         _x1, _y1, _x2, _y2 = page_layout.bbox
         for i, element in enumerate(page_layout):
             if isinstance(element, LTTextContainer):
@@ -86,6 +258,7 @@ def extract_test_features(file):
     return test_df, True
 
 
+@timed("feature_building")
 def create_test_features(df):
     df["len_of_text"] = df["text"].apply(len)
     # df['len_of_text'] = df['text'].apply(lambda x: len(x.split()))
@@ -112,66 +285,341 @@ def create_test_features(df):
     return df
 
 
+def _rank_descending(values):
+    # same as pandas rank(ascending=False, method="min")
+    return (values[None, :] > values[:, None]).sum(axis=1) + 1
+
+
+def _title_features_pdfminer(file):
+    df, status = extract_test_features(file)
+    if not status:
+        return df, False
+    df = create_test_features(df)
+    return (list(df["text"]), df[FEATURE_COLUMNS].to_numpy(dtype=np.float32)), True
+
+
+@timed("title_features")
+def extract_title_features(file):
+    """
+    Fast first page title candidates, reads only the first page with PyMuPDF
+
+    Returns ((texts, features), True) with features in FEATURE_COLUMNS order,
+    computed like extract_test_features + create_test_features, or
+    (error, False). Pages PyMuPDF can't decode or splits into an unusual
+    number of boxes go through the pdfminer path, with the same handle.
+    """
+    with as_document(file) as document:
+        return _extract_title_features(document)
+
+
+def _extract_title_features(file):
+    try:
+        # pdfminer keeps text running off the page, so no clipping here
+        page = file.fitz[0].get_text(
+            "dict",
+            flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_MEDIABOX_CLIP,
+            clip=fitz.INFINITE_RECT(),
+        )
+    except (RuntimeError, ValueError, IndexError):
+        return _title_features_pdfminer(file)
+
+    texts = []
+    fonts = []
+    squares = []
+    ids = []
+    for block in page["blocks"]:
+        if block["type"] != 0:
+            continue
+        spans = [span for line in block["lines"] for span in line["spans"]]
+        text = "".join(span["text"] for span in spans)
+
+        if "\ufffd" in text:
+            return _title_features_pdfminer(file)
+
+        if text.split() != [] and len(text) > 4:
+            texts.append(text)
+            font = next((s["font"].lower() for s in spans if s["text"].strip()), "")
+            if "bold" in font:
+                fonts.append(1)
+            elif "italic" in font:
+                fonts.append(2)
+            else:
+                fonts.append(0)
+
+            # pdfminer boxes span font size from the descent line, not the
+            # ascender/descender box PyMuPDF reports, keep squares comparable
+            x1, _, x2, _ = block["bbox"]
+            y1 = min(s["origin"][1] - s["size"] * (1 + s["descender"]) for s in spans)
+            y2 = max(s["origin"][1] - s["size"] * s["descender"] for s in spans)
+            squares.append((int(x2) - int(x1)) * (int(y2) - int(y1)))
+            ids.append(block["number"])
+
+    if not texts:
+        return "Файл состоит из сканов", False
+    if not 3 <= len(texts) <= 25:
+        return _title_features_pdfminer(file)
+
+    fonts = np.array(fonts)
+    ids = np.array(ids)
+    features = np.column_stack(
+        [
+            fonts,
+            _rank_descending(np.array([len(text) for text in texts])),
+            _rank_descending(np.array(squares)),
+            np.full(len(texts), int(fonts.mean() * 100)),
+            (ids / ids.max() * 100).astype(int),
+        ]
+    ).astype(np.float32)
+    return (texts, features), True
+
+
+@timed("inference")
+def score_titles(checkpoint_name, features, cascade=False):
+    """
+    Title probability of every box, features as returned by extract_title_features
+
+    With cascade models after the first one are only run while the title
+    is unclear, when the checkpoint was calibrated by python -m ml.calibrate.
+    """
+    ensemble = load_ensemble(checkpoint_name)
+    if cascade and ensemble.margin is not None:
+        scores, _ = ensemble.predict_cascaded(features, ensemble.margin)
+        return scores
+    return ensemble.predict(features)
+
+
 def inference_models(checkpoint_name, test_df):
-    columns_to_use = [
-        "font",
-        "rank",
-        "rank_squares",
-        "bold_percentage",
-        "id_percentage",
-    ]
-    with open(checkpoint_name, "rb") as f:
-        models = pickle.load(f)
-
-    test_pool = Pool(data=test_df[columns_to_use])
-    preds = []
-    for model in models:
-        preds.append(model.predict_proba(test_pool)[:, 1])
-    test_df["pred"] = np.mean(preds, axis=0)
+    features = test_df[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+    test_df["pred"] = score_titles(checkpoint_name, features)
     return test_df, test_df.loc[test_df["pred"].idxmax(), "text"].strip()
 
 
+def title_candidates(texts, scores, k):
+    """Best k distinct texts by score_titles result with their probabilities"""
+    candidates = {}
+    for i in np.argsort(-scores, kind="stable"):
+        text = texts[i].strip()
+        if text and text not in candidates:
+            candidates[text] = float(scores[i])
+            if len(candidates) == k:
+                break
+    return [{"title": text, "probability": pred} for text, pred in candidates.items()]
+
+
+def _closest_window(target, string, stride_length, threshold):
+    target_length = len(target.split())
+    all_distances = []
+    string_words = string.split()
+
+    if len(string_words) > target_length:
+        i = 0
+        while i < len(string_words) - target_length + 1:
+            window = " ".join(string_words[i : i + target_length])
+
+            distance = lev.distance(target, window) / len(target)
+            if distance < threshold:
+                for j in range(
+                    max(i - target_length, 0),
+                    min(i + target_length, len(string_words) - target_length + 1),
+                ):
+                    detailed_window = " ".join(string_words[j : j + target_length])
+                    detailed_distance = lev.distance(target, detailed_window) / len(
+                        target
+                    )
+
+                    all_distances.append((detailed_window, detailed_distance * 100))
+                i += stride_length
+            else:
+                i += stride_length
+    else:
+        dist = lev.distance(target, string) / len(target)
+        all_distances.append((string, dist * 100))
+
+    if all_distances:
+        return min(all_distances, key=lambda x: x[1])
+    return None
+
+
+@timed("distances")
 def calculate_distances(target, list_of_strings, stride_fraction=1 / 4, threshold=0.3):
+    """
+    Closest target sized window of every string, as [window, distance * 100]
+
+    Results are memoized by (target, text) in the result cache, boilerplate
+    boxes repeated across pages and documents are computed once.
+    """
     target_length = len(target.split())
     min_distances = []
 
     stride_length = math.ceil(target_length * stride_fraction)
 
-    for string in list_of_strings:
-        all_distances = []
-        string_words = string.split()
-
-        if len(string_words) > target_length:
-            i = 0
-            while i < len(string_words) - target_length + 1:
-                window = " ".join(string_words[i : i + target_length])
-
-                distance = lev.distance(target, window) / len(target)
-                if distance < threshold:
-                    for j in range(
-                        max(i - target_length, 0),
-                        min(i + target_length, len(string_words) - target_length + 1),
-                    ):
-                        detailed_window = " ".join(string_words[j : j + target_length])
-                        detailed_distance = lev.distance(target, detailed_window) / len(
-                            target
-                        )
-
-                        all_distances.append((detailed_window, detailed_distance * 100))
-                    i += stride_length
-                else:
-                    i += stride_length
+    cache = get_cache()
+    keys = [
+        cache.key("distances", target, string, stride_length, threshold)
+        for string in list_of_strings
+    ]
+    found = cache.get_many(keys)
+    computed = {}
+    for key, string in zip(keys, list_of_strings):
+        if key in found:
+            min_window = found[key]
         else:
-            dist = lev.distance(target, string) / len(target)
-            all_distances.append((string, dist * 100))
-
-        if all_distances:
-            min_window = min(all_distances, key=lambda x: x[1])
+            min_window = found[key] = computed[key] = _closest_window(
+                target, string, stride_length, threshold
+            )
+        if min_window:
             min_distances.append([min_window[0], min_window[1]])
+    cache.set_many(computed)
 
     return min_distances
 
 
+class PageText:
+    """
+    Text boxes of a page as one normalized stream of words
+
+    Words of all boxes follow each other in page order, offsets are the
+    sorted stream offsets the boxes start at, so any word of the stream
+    resolves to its box and coordinates with a bisect. Windows are word
+    spans of the stream and can run over several boxes.
+    """
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.words = []
+        self.offsets = []
+        for text, _, _ in boxes:
+            self.offsets.append(len(self.words))
+            self.words += text.split()
+        self.text = " ".join(self.words)
+
+    def box_at(self, word):
+        return bisect.bisect_right(self.offsets, word) - 1
+
+    def locate(self, first_word, end_word):
+        """
+        Raw text and relative coords of words first_word:end_word
+
+        A window inside one box gets the whole box, as matches always had.
+        A window running over several boxes gets only the lines of its words
+        in the first and the last box, so a title broken before a paragraph
+        does not frame the whole paragraph.
+        """
+        first, last = self.box_at(first_word), self.box_at(end_word - 1)
+        if first == last:
+            return self.boxes[first][1], self.boxes[first][2]
+        parts = []
+        for box in range(first, last + 1):
+            _, raw, coords = self.boxes[box]
+            offset = self.offsets[box]
+            words = range(max(first_word - offset, 0), end_word - offset)
+            parts.append(_box_lines(raw, coords, words))
+        x1 = min(coords[0] for _, coords in parts)
+        y1 = min(coords[1] for _, coords in parts)
+        x2 = max(coords[0] + coords[2] for _, coords in parts)
+        y2 = max(coords[1] + coords[3] for _, coords in parts)
+        return "\n".join(raw for raw, _ in parts), [x1, y1, x2 - x1, y2 - y1]
+
+
+WORD = re.compile(r"\S+")
+
+
+def _box_lines(raw, coords, words):
+    """
+    Raw text of the words of a box and coords of their lines
+
+    Lines share the box height evenly, coords are relative to the bottom
+    left corner, so the first line is at the top of the box.
+    """
+    spans = list(WORD.finditer(raw))[words.start : words.stop]
+    if not spans:
+        return raw, coords
+    top = raw.count("\n", 0, spans[0].start())
+    bottom = raw.count("\n", 0, spans[-1].start())
+    lines = raw.rstrip("\n").count("\n") + 1
+    x, y, width, height = coords
+    line_height = height / lines
+    return raw[spans[0].start() : spans[-1].end()], [
+        x,
+        y + (lines - 1 - bottom) * line_height,
+        width,
+        (bottom - top + 1) * line_height,
+    ]
+
+
+def _closest_windows(target, page, stride_length, threshold, max_distance):
+    target_length = len(target.split())
+    words = page.words
+    last_start = len(words) - target_length + 1
+    distances = {}
+
+    def distance(start, end):
+        dist = distances.get((start, end))
+        if dist is None:
+            window = " ".join(words[start:end])
+            dist = distances[start, end] = lev.distance(target, window) / len(target)
+        return dist
+
+    # strides start at every box, as calculate_distances does per box, but
+    # windows go on into the next boxes
+    for first, last in zip(page.offsets, page.offsets[1:] + [len(words)]):
+        if 0 < last - first <= target_length:
+            distance(first, last)
+        for i in range(first, min(last, last_start), stride_length):
+            if distance(i, i + target_length) < threshold:
+                for j in range(
+                    max(i - target_length, 0), min(i + target_length, last_start)
+                ):
+                    distance(j, j + target_length)
+
+    # each word belongs to one window at most, windows inside one box go
+    # first, so a title is not stretched over a neighbouring box because
+    # that is a bit closer to the target, then the best ones
+    candidates = sorted(
+        (page.box_at(start) != page.box_at(end - 1), dist, start, end)
+        for (start, end), dist in distances.items()
+        if dist * 100 < max_distance
+    )
+    taken = [False] * len(words)
+    windows = []
+    for _, dist, start, end in candidates:
+        if not any(taken[start:end]):
+            taken[start:end] = [True] * (end - start)
+            windows.append((start, end, " ".join(words[start:end]), dist * 100))
+    return sorted(windows)
+
+
+@timed("distances")
+def page_distances(
+    target, page, max_distance=math.inf, stride_fraction=1 / 4, threshold=0.3
+):
+    """
+    Closest target sized windows of a PageText, searched over the page at once
+
+    Returns non-overlapping (first word, end word, window, distance * 100)
+    closer than max_distance in page order. These are the windows
+    calculate_distances finds per box and ones running over box boundaries,
+    e.g. titles broken into several boxes. Memoized by target and page
+    boxes in the result cache.
+    """
+    stride_length = math.ceil(len(target.split()) * stride_fraction)
+    cache = get_cache()
+    key = cache.key(
+        "page_distances",
+        target,
+        page.text,
+        page.offsets,
+        max_distance,
+        stride_length,
+        threshold,
+    )
+    windows = cache.get(key)
+    if windows is MISSING:
+        windows = _closest_windows(target, page, stride_length, threshold, max_distance)
+        cache.set(key, windows)
+    return windows
+
+
 def replace_multiple_spaces(text):
     return re.sub(" +", " ", text)
 
@@ -179,51 +627,208 @@ def replace_multiple_spaces(text):
 nlp = spacy.load("ru_core_news_sm")
 
 
-def remove_special_characters(string):
-    return re.sub(r"\W", "", string)
+NON_WORD = re.compile(r"\W")
+# word -> (lemma, part of speech), filled in batches by _lemmatize
+_tokens = {}
+_TOKENS_LIMIT = 100_000
 
 
-def difference_type(word1, word2):
-    if word1 == word2:
-        return None  # слова совпадают, пропускаем их
+def remove_special_characters(string):
+    return NON_WORD.sub("", string)
+
 
-    if remove_special_characters(word1) == remove_special_characters(word2):
-        return "Пропущен специцальный символ"
+@lru_cache(maxsize=65536)
+def _normalize(word):
+    return remove_special_characters(word), word.lower(), word.isdigit()
 
-    if word1.lower() == word2.lower():
-        return "Разная капитуляция слов"
 
-    if word1.isdigit() and word2.isdigit():
-        if abs(int(word1) - int(word2)) < 10:
-            return "Небольшое числовое различие"
+def _lemmatize(words):
+    """word -> (lemma, part of speech) for all words, unknown ones parsed in one batch"""
+    tokens, missing = {}, []
+    for word in dict.fromkeys(words):
+        if word in _tokens:
+            tokens[word] = _tokens[word]
         else:
-            return "Разные числа"
+            missing.append(word)
+    if not missing:
+        return tokens
+    if len(_tokens) + len(missing) > _TOKENS_LIMIT:
+        _tokens.clear()
+    # dependencies and entities do not change lemma and pos of a single word
+    disable = [name for name in ("parser", "ner") if name in nlp.pipe_names]
+    for word, doc in zip(missing, nlp.pipe(missing, disable=disable)):
+        tokens[word] = _tokens[word] = (doc[0].lemma_, doc[0].pos_)
+    return tokens
+
+
+def difference_types(pairs):
+    """
+    difference_type for a list of word pairs at once
+
+    Cheap checks run over all pairs first, words of the pairs left
+    unresolved go through spaCy in a single batch.
+    """
+    result = [None] * len(pairs)
+    unresolved = []
+    for i, (word1, word2) in enumerate(pairs):
+        if word1 == word2:
+            continue  # слова совпадают, пропускаем их
+
+        stripped1, lower1, digit1 = _normalize(word1)
+        stripped2, lower2, digit2 = _normalize(word2)
+        if stripped1 == stripped2:
+            result[i] = "Пропущен специцальный символ"
+        elif lower1 == lower2:
+            result[i] = "Разная капитуляция слов"
+        elif digit1 and digit2:
+            if abs(int(word1) - int(word2)) < 10:
+                result[i] = "Небольшое числовое различие"
+            else:
+                result[i] = "Разные числа"
+        else:
+            unresolved.append(i)
+
+    tokens = _lemmatize(word for i in unresolved for word in pairs[i])
+    for i in unresolved:
+        word1, word2 = pairs[i]
+        lemma1, pos1 = tokens[word1]
+        lemma2, pos2 = tokens[word2]
+        if lemma1 == lemma2:
+            if pos1 != pos2:
+                result[i] = "Разные формы слова"
+            else:
+                result[i] = "Одинаковый корень, но разные формы"
+        elif Levenshtein.distance(word1, word2) <= 2:
+            result[i] = "Возможная орфографическая ошибка или опечатка"
+        else:
+            result[i] = "Разные слова"
+    return result
 
-    token1 = nlp(word1)[0]
-    token2 = nlp(word2)[0]
-    if token1.lemma_ == token2.lemma_:
-        if token1.pos_ != token2.pos_:
-            return "Разные формы слова"
+
+def difference_type(word1, word2):
+    return difference_types([(word1, word2)])[0]
+
+
+def _myers(a, b, similar):
+    """Myers O((N+M)D) diff, returns ("equal" | "delete" | "insert", i, j) ops"""
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in range(n + m + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and similar(a[x], b[y]):
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                break
         else:
-            return "Одинаковый корень, но разные формы"
+            continue
+        break
 
-    if Levenshtein.distance(word1, word2) <= 2:
-        return "Возможная орфографическая ошибка или опечатка"
-    return "Разные слова"
+    ops = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            ops.append(("equal", x, y))
+        if d > 0:
+            if x == prev_x:
+                ops.append(("insert", None, y - 1))
+            else:
+                ops.append(("delete", x - 1, None))
+        x, y = prev_x, prev_y
+    ops.reverse()
+    return ops
+
+
+def _similar_keys(key1, key2):
+    # fuzzy match cost: case, punctuation and single typos keep words aligned
+    if key1 == key2:
+        return True
+    return min(len(key1), len(key2)) > 3 and Levenshtein.distance(key1, key2) <= 1
+
+
+def align_words(words1, words2):
+    """
+    Pairs words of two strings by token alignment instead of position
+
+    Returns (pairs, words only in first, words only in second), unmatched
+    words between two aligned ones are paired in order as substitutions.
+    """
+    pairs = []
+    words1_only = []
+    words2_only = []
+    deleted = []
+    inserted = []
+
+    def flush():
+        pairs.extend(zip(deleted, inserted))
+        words1_only.extend(deleted[len(inserted) :])
+        words2_only.extend(inserted[len(deleted) :])
+        deleted.clear()
+        inserted.clear()
+
+    keys1 = [_normalize(word)[0].lower() for word in words1]
+    keys2 = [_normalize(word)[0].lower() for word in words2]
+    for op, i, j in _myers(keys1, keys2, _similar_keys):
+        if op == "equal":
+            flush()
+            pairs.append((words1[i], words2[j]))
+        elif op == "delete":
+            deleted.append(words1[i])
+        else:
+            inserted.append(words2[j])
+    flush()
+    return pairs, words1_only, words2_only
+
+
+@timed("compare_strings")
+def compare_strings(str1, str2, align=False):
+    """
+    Word level differences of str1 from str2, memoized in the result cache
+
+    Returns (differences, diff_types), the values are shared with the cache
+    and must not be modified.
+    """
+    cache = get_cache()
+    key = cache.key("compare_strings", str1, str2, align)
+    result = cache.get(key)
+    if result is MISSING:
+        result = _compare_strings(str1, str2, align)
+        cache.set(key, result)
+    return result
 
 
-def compare_strings(str1, str2):
+def _compare_strings(str1, str2, align):
     words1 = str1.split()
     words2 = str2.split()
 
-    words1_only = set(words1) - set(words2)
-    words2_only = set(words2) - set(words1)
-
-    differences = []
-    mn_len = min(len(words1), len(words2))
-    for i in range(mn_len):
-        difference = difference_type(words1[i], words2[i])
-        differences.append((words1[i], words2[i], difference))
+    if align:
+        pairs, words1_only, words2_only = align_words(words1, words2)
+    else:
+        words1_only = set(words1) - set(words2)
+        words2_only = set(words2) - set(words1)
+        pairs = list(zip(words1, words2))
+    differences = [
+        (word1, word2, difference)
+        for (word1, word2), difference in zip(pairs, difference_types(pairs))
+    ]
 
     for word in words1_only:
         differences.append((word, None, "Word only in first string"))
@@ -239,81 +844,50 @@ def compare_strings(str1, str2):
     return differences, diff_types
 
 
-def get_matches(file, target):
+def iter_matches(
+    file, target, max_memory=None, first_page=1, align=False, cache_pages=False
+):
+    """
+    Yields (page number, matches on page) for every page from first_page
+
+    file is a path, io.BytesIO or ml.document handle of the pdf, matching
+    reuses the boxes of a handle's layout backend. Every page is searched
+    as one PageText, matches running over several boxes have the raw text
+    of all of them and the bounding box of their coordinates. With align
+    words of matched windows are paired by token alignment, see
+    compare_strings. cache_pages keeps page boxes for matching another
+    title of the document, see iter_cached_page_texts.
+    """
     target = replace_multiple_spaces(target)
-
+    pages = iter_cached_page_texts if cache_pages else iter_page_texts
+
+    for page, boxes in pages(file, max_memory, first_page):
+        page_text = PageText(boxes)
+
+        result = []
+        # distances are in percent, matches are closer than 0.2 per target char
+        windows = page_distances(target, page_text, max_distance=0.2 * len(target))
+        for first, end, window, distance in windows:
+            raw_text, rel_coord = page_text.locate(first, end)
+            difference, diff_types = compare_strings(window, target, align)
+            result.append(
+                {
+                    "page": page,
+                    "window": window,
+                    "coordinates": rel_coord,
+                    "distance": distance / len(target),
+                    "diff_type": list(diff_types),
+                    "raw_text": raw_text,
+                }
+            )
+        yield page, result
+
+
+@timed("matching")
+def get_matches(file, target, max_memory=None, align=False, cache_pages=False):
     result = []
-    for i, page_layout in enumerate(tqdm(extract_pages(file))):
-        _x1, _y1, _x2, _y2 = page_layout.bbox
-        texts = []
-        relative_coords = []
-        d = {}
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                # print(element.get_text())
-                x1, y1, x2, y2 = element.bbox
-                raw = element.get_text()
-                text = replace_multiple_spaces(raw.replace("\n", " ").strip())
-                if len(text) > 3:
-                    relative_coords.append(
-                        ([x1 / _x2, y1 / _y2, (x2 - x1) / _x2, (y2 - y1) / _y2])
-                    )
-                    texts.append(text)
-                    d[text] = raw
-
-        distances = calculate_distances(target, texts)
-
-        for window, distance in distances:
-            if distance / len(target) < 0.2:
-                # print(i)
-                # print(window)
-                for j in range(len(texts)):
-                    if window in texts[j]:
-                        raw_text = d[texts[j]]
-                        rel_coord = relative_coords[j]
-                        break
-                difference, diff_types = compare_strings(window, target)
-                result.append(
-                    {
-                        "page": i + 1,
-                        "window": window,
-                        "coordinates": rel_coord,
-                        "distance": distance / len(target),
-                        "diff_type": list(diff_types),
-                        "raw_text": raw_text,
-                    }
-                )
+    for _, matches in tqdm(
+        iter_matches(file, target, max_memory, align=align, cache_pages=cache_pages)
+    ):
+        result += matches
     return result
-
-
-# if __name__ == "__main__":
-#     file = "some.pdf"
-#     columns_to_use = [
-#         "font",
-#         "rank",
-#         "rank_squares",
-#         "bold_percentage",
-#         "id_percentage",
-#     ]
-#     checkpoint_name = "checkpoints/models.pkl"
-#
-#     test_df, result = extract_test_features(file)
-#
-#     if isinstance(test_df, pd.DataFrame):
-#         test_df = create_test_features(test_df)
-#     else:
-#         print(result)
-#
-#     _, target = inference_models(checkpoint_name, test_df, columns_to_use)
-#
-#     result = []
-#     for page_layout in tqdm(extract_pages(file)):
-#         texts = []
-#         for element in page_layout:
-#             if isinstance(element, LTTextContainer):
-#                 texts.append(element.get_text().replace("\n", ""))
-#         distances = calculate_distances(target, texts)
-#
-#         for window, distance in distances.items():
-#             if distance < 20:
-#                 result.append(window)
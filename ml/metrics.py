@@ -0,0 +1,115 @@
+import functools
+import math
+import threading
+import time
+from contextvars import ContextVar
+
+# seconds, upper bounds of histogram buckets (last one is +Inf)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# upper bounds of page count groups, documents above the last one go to "+Inf"
+PAGE_GROUPS = (1, 10, 50, 100, 500, 1000)
+
+METRIC_NAME = "dock_checker_stage_duration_seconds"
+
+_pages: ContextVar[int | None] = ContextVar("pages", default=None)
+_lock = threading.Lock()
+_registry: dict[tuple[str, str], list] = {}
+
+
+def page_group(pages: int | None) -> str:
+    if pages is None:
+        return "unknown"
+    for bound in PAGE_GROUPS:
+        if pages <= bound:
+            return str(bound)
+    return "+Inf"
+
+
+def _bucket_label(bound: float) -> str:
+    return "+Inf" if math.isinf(bound) else repr(float(bound))
+
+
+def observe(stage: str, seconds: float, pages: int | None = None):
+    """Records one stage duration, pages default to the current document"""
+    if pages is None:
+        pages = _pages.get()
+    key = (stage, page_group(pages))
+    with _lock:
+        # [bucket counts..., +Inf count, sum]
+        series = _registry.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0])
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                series[i] += 1
+        series[len(BUCKETS)] += 1
+        series[-1] += seconds
+
+
+def set_pages(pages: int | None):
+    """Sets page count label for following stages, returns token for reset_pages"""
+    return _pages.set(pages)
+
+
+def reset_pages(token):
+    _pages.reset(token)
+
+
+class timed:
+    """Times the wrapped block or function as a pipeline stage"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self._start)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+def timed_iter(stage: str, iterable):
+    """Times every step of a lazy iterator, e.g. pdfminer page layouts"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(stage, time.perf_counter() - start)
+        yield item
+
+
+def drain() -> dict[tuple[str, str], list]:
+    """Returns collected series and resets the process local registry"""
+    global _registry
+    with _lock:
+        data, _registry = _registry, {}
+    return data
+
+
+def render(data: dict[tuple[str, str], list]) -> str:
+    """Renders series to prometheus text exposition format"""
+    lines = [
+        f"# HELP {METRIC_NAME} Duration of document pipeline stages.",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    bounds = BUCKETS + (math.inf,)
+    for (stage, pages), series in sorted(data.items()):
+        labels = f'stage="{stage}",pages="{pages}"'
+        for bound, count in zip(bounds, series):
+            lines.append(
+                f'{METRIC_NAME}_bucket{{{labels},le="{_bucket_label(bound)}"}} {count}'
+            )
+        lines.append(f"{METRIC_NAME}_sum{{{labels}}} {series[-1]}")
+        lines.append(f"{METRIC_NAME}_count{{{labels}}} {series[len(BUCKETS)]}")
+    return "\n".join(lines) + "\n"
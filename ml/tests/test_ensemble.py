@@ -0,0 +1,24 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("catboost")
+
+from ml.benchmarks.__main__ import reference_scores  # noqa: E402
+from ml.main import FEATURE_COLUMNS, score_titles  # noqa: E402
+
+CHECKPOINT = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "checkpoints", "models.pkl"
+)
+
+
+@pytest.mark.parametrize("rows", [1, 25, 500])
+def test_score_titles_matches_catboost(rows):
+    rng = np.random.default_rng(rows)
+    # features out of the training range go through the outer tree borders
+    x = rng.integers(-10, 110, (rows, len(FEATURE_COLUMNS))).astype(np.float32)
+    expected = reference_scores(CHECKPOINT, pd.DataFrame(x, columns=FEATURE_COLUMNS))
+
+    np.testing.assert_allclose(score_titles(CHECKPOINT, x), expected, rtol=0, atol=1e-9)
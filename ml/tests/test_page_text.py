@@ -0,0 +1,43 @@
+import pytest
+
+from ml.main import PageText, page_distances
+
+TITLE = "Residential complex with underground parking on Lenin street stage 2"
+# title broken into two boxes, the second one goes on with a paragraph
+BOXES = [
+    ("Residential complex with", "Residential complex with\n", [0.1, 0.8, 0.5, 0.05]),
+    (
+        "underground parking on Lenin street stage 2 The project consists of "
+        "ten sections built in two stages",
+        "underground parking on Lenin street stage 2\n"
+        "The project consists of ten sections\n"
+        "built in two stages\n",
+        [0.1, 0.5, 0.8, 0.3],
+    ),
+]
+
+
+def test_split_title_is_found_over_boxes():
+    page = PageText(BOXES)
+    windows = page_distances(TITLE, page, max_distance=0.2 * len(TITLE))
+
+    assert [(first, end, window) for first, end, window, _ in windows] == [
+        (0, 10, TITLE)
+    ]
+
+
+def test_split_title_is_located_without_the_paragraph():
+    raw_text, coords = PageText(BOXES).locate(0, 10)
+
+    assert raw_text == (
+        "Residential complex with\nunderground parking on Lenin street stage 2"
+    )
+    # the first line of the second box up to the top of the first one
+    assert coords == pytest.approx([0.1, 0.7, 0.8, 0.15])
+
+
+def test_window_inside_a_box_is_located_as_the_box():
+    raw_text, coords = PageText(BOXES).locate(3, 6)
+
+    assert raw_text == BOXES[1][1]
+    assert coords == BOXES[1][2]
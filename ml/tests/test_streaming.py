@@ -0,0 +1,50 @@
+import os
+
+import fitz
+import pytest
+
+from ml import main
+from ml.benchmarks.__main__ import peak_rss_growth
+from ml.benchmarks.pdfs import make_pdf
+
+PAGES = 128
+# side of the incompressible image on every page, pdfminer caches its
+# stream with the page objects, so unreleased caches grow by IMAGE_BYTES a page
+IMAGE_SIDE = 512
+IMAGE_BYTES = IMAGE_SIDE * IMAGE_SIDE * 3
+
+
+@pytest.fixture(scope="module")
+def pdf(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("pdfs")
+    path = make_pdf(str(workdir / "text.pdf"), pages=PAGES)
+    doc = fitz.open(path)
+    for page in doc:
+        image = fitz.Pixmap(
+            fitz.csRGB, IMAGE_SIDE, IMAGE_SIDE, os.urandom(IMAGE_BYTES), 0
+        )
+        page.insert_image(fitz.Rect(72, 400, 272, 600), pixmap=image)
+    path = str(workdir / f"{PAGES}.pdf")
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def test_released_caches_bound_peak_memory(pdf):
+    unbounded = peak_rss_growth(pdf)
+    # every process is over one megabyte, so caches go once per interval
+    bounded = peak_rss_growth(pdf, max_memory=1)
+
+    # unreleased caches hold every image, released ones at most an interval of them
+    assert unbounded - bounded > (PAGES - 2 * main.RELEASE_INTERVAL) * IMAGE_BYTES
+
+
+def test_caches_are_released_once_per_interval(pdf, monkeypatch):
+    released = []
+    monkeypatch.setattr(
+        main, "_release_caches", lambda document, resources: released.append(1)
+    )
+    pages = sum(1 for _ in main.iter_page_layouts(pdf, max_memory=1))
+
+    assert pages == PAGES
+    assert len(released) == -(-pages // main.RELEASE_INTERVAL)